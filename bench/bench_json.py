@@ -0,0 +1,56 @@
+"""
+Compare encoding the chart state sent to the web view with simplejson, as
+used before, and the jsonio encoders.
+
+    python -m bench.bench_json [points]
+"""
+import json
+import sys
+import timeit
+
+from pychart import jsonio
+from pychart import sources
+from pychart.sources import SourceStore
+
+
+def createState(points):
+    store = SourceStore({
+        'x': range(points),
+        'y': [i * 0.5 for i in range(points)],
+        'label': [str(i) for i in range(points // 10)],
+    })
+    traces = [{'type': 'scatter', 'x': store['x'], 'y': store['y'],
+               'meta': {'columnNames': {'x': 'x', 'y': 'y'}}}]
+    return {'dataSources': store, 'data': traces, 'layout': {}}
+
+
+def bench(label, fn, number=1):
+    seconds = min(timeit.repeat(fn, number=number, repeat=3)) / number
+    print(f'{label:<24} {seconds * 1000:9.1f} ms')
+
+
+def main():
+    points = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    state = createState(points)
+    print(f'{points} points, numpy: {bool(sources.numpy)}, '
+          f'orjson: {bool(jsonio.orjson)}')
+
+    try:
+        import simplejson
+        bench('simplejson', lambda: simplejson.dumps(state, iterable_as_array=True,
+                                                     default=jsonio.default))
+    except ImportError:
+        pass
+
+    bench('json', lambda: json.dumps(state, default=jsonio.default))
+
+    if jsonio.orjson:
+        bench('jsonio (orjson)', lambda: jsonio.dumps(state))
+
+        text = jsonio.dumps(state)
+        bench('json.loads', lambda: json.loads(text))
+        bench('jsonio.loads (orjson)', lambda: jsonio.loads(text))
+
+
+if __name__ == '__main__':
+    main()
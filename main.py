@@ -1,51 +1,195 @@
 
 import argparse
+import ast
+import csv
 import multiprocessing
+import os
 import sys
+import traceback
 
-from PyQt5.QtWidgets import QApplication
-from pychart.app import MainWindow, initApp, exportImage
+from pychart.common import StartupProfiler
 
+# the Qt modules are imported by each command so that '--help' stays fast
+profiler = StartupProfiler()
 
-def init():
+
+def init(args):
     """
     Setup Python configuration
     """
+    from pychart.evaluate import setStartMethod, setPoolSize
+    from pychart.sources import setMemoryBudget
+    from pychart.worker import setDefaultEvaluator
+
     def excepthook(exc_type, exc_value, exc_tb):
         traceback.print_exception(exc_type, exc_value, exc_tb)
 
         if exc_type is KeyboardInterrupt:
+            from PyQt5.QtWidgets import QApplication
             QApplication.quit()
 
     # use custom handler for exceptions when frozen
     if getattr(sys, 'frozen', False):
         sys.excepthook = excepthook
 
-    # only the 'folk' method of starting a process is compatable with cx_Freeze
-    multiprocessing.set_start_method('fork')
+    # only the 'folk' method of starting a process is compatable with cx_Freeze,
+    # otherwise fork workers from a server that has not loaded Qt
+    if getattr(sys, 'frozen', False):
+        multiprocessing.set_start_method('fork')
+        setStartMethod('fork')
+    else:
+        preload = [m for arg in args.preload for m in arg.split(',') if m]
+        setStartMethod('forkserver', preload)
+
+    setDefaultEvaluator(args.evaluator)
+    setPoolSize(args.workers)
+
+    if args.memoryBudget:
+        setMemoryBudget(int(args.memoryBudget * 1024 * 1024))
+
+    if args.webglThreshold is not None:
+        from pychart.chart import setWebGLThreshold
+        setWebGLThreshold(args.webglThreshold or None)
 
 
 def gui(args):
     """
     Create and start windowed Qt application.
     """
+    # web engine must be imported before the application is created
+    from PyQt5.QtCore import QTimer
+    from PyQt5.QtWidgets import QApplication
+    from pychart.app import MainWindow, initApp
+    profiler.mark('import modules')
+
     app = QApplication(sys.argv)
     initApp(app)
+    profiler.mark('create application')
 
     path = args.input if hasattr(args, 'input') else None
-    MainWindow.create(path)
+    window = MainWindow.create(path)
+    profiler.mark('create window')
+
+    if profiler.enabled:
+        QTimer.singleShot(0, lambda: profiler.mark('show window'))
+        window.chartEditor.handler.chartReady.connect(
+            lambda: profiler.mark('chart ready')
+        )
 
     sys.exit(app.exec_())
 
 
+def parseValue(text):
+    """
+    Read a parameter value as a Python literal, or else as a string.
+    """
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def parseParam(text):
+    """
+    Parse a key=value parameter argument.
+    """
+    (key, sep, value) = text.partition('=')
+    if not sep or not key.isidentifier():
+        raise argparse.ArgumentTypeError(f'expected key=value, got {text!r}')
+
+    return (key, parseValue(value))
+
+
+def parseSize(text):
+    """
+    Parse a WIDTHxHEIGHT size argument.
+    """
+    try:
+        (width, height) = map(int, text.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected WIDTHxHEIGHT, got {text!r}')
+
+    return (width, height)
+
+
+def createOutputs(args):
+    """
+    List the (path template, width, height) of each image of a document. One
+    output path is used for every size, otherwise there is a path per size.
+    """
+    sizes = args.size or [(args.width, args.height)]
+
+    if len(args.output) == len(sizes):
+        return [(o, w, h) for (o, (w, h)) in zip(args.output, sizes)]
+
+    if len(sizes) == 1:
+        return [(o, *sizes[0]) for o in args.output]
+
+    if len(args.output) == 1:
+        return [(args.output[0], w, h) for (w, h) in sizes]
+
+    raise SystemExit('error: give one output path, or one per --size')
+
+
+def createVariants(args):
+    """
+    List the (params, outputs) of each document to export, where outputs are
+    (image path, width, height) tuples. Each row of the sweep file is a
+    variant with the --param values as defaults. Output paths are formatted
+    with the params, the row index and the image width and height.
+    """
+    params = dict(args.param)
+    rows = [params]
+
+    if args.sweep:
+        with open(args.sweep, newline='') as f:
+            rows = [dict(params, **{k: parseValue(v) for k, v in row.items()})
+                    for row in csv.DictReader(f)]
+
+    variants = []
+    for (index, row) in enumerate(rows):
+        try:
+            outputs = [(path.format(index=index, width=w, height=h, **row), w, h)
+                       for (path, w, h) in createOutputs(args)]
+        except (KeyError, IndexError, ValueError) as e:
+            raise SystemExit(f'error: can not format output path: {e!r}')
+
+        variants.append((row, outputs))
+
+    paths = [path for (_, outputs) in variants for (path, _, _) in outputs]
+    if len(set(paths)) < len(paths):
+        raise SystemExit('error: output paths must differ per sweep row and '
+                         'size, e.g. include {index} or {width}x{height}')
+
+    return variants
+
+
 def run(args):
     """
     Create Qt application and execute an image export.
     """
+    variants = createVariants(args)
+
+    # render without a display, nothing is shown by this command
+    noDisplay = sys.platform.startswith('linux') and \
+                not os.environ.get('DISPLAY') and \
+                not os.environ.get('WAYLAND_DISPLAY')
+    if args.headless or noDisplay:
+        os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+
+    from PyQt5.QtWidgets import QApplication
+    from pychart.app import initApp, exportImages
+    profiler.mark('import modules')
+
     app = QApplication(sys.argv)
     initApp(app)
+    profiler.mark('create application')
+
+    def exported(failures):
+        profiler.mark('export image')
+        app.exit(1 if failures else 0)
 
-    exportImage(args.input, args.output, args.width, args.height, app.quit)
+    exportImages(args.input, variants, exported, args.timeout, args.scale)
 
     sys.exit(app.exec_())
 
@@ -55,6 +199,32 @@ def parse():
     Parse command-line arguments
     """
     parser = argparse.ArgumentParser(description='python based chart design tool')
+    parser.add_argument('--profile-startup', dest='profileStartup',
+                        action='store_true',
+                        help='report startup timings on stderr')
+    parser.add_argument('--preload', action='append', metavar='MODULE',
+                        default=[os.environ.get('PYCHART_PRELOAD', '')],
+                        help='comma separated modules to import once for all '
+                             'script evaluations, such as numpy,pandas '
+                             '(default: $PYCHART_PRELOAD)')
+    parser.add_argument('--evaluator', choices=['ipython', 'exec'],
+                        default='ipython',
+                        help='script evaluator for documents which do not '
+                             'select one, exec is lighter but does not support '
+                             'IPython syntax (default: %(default)s)')
+    parser.add_argument('--workers', type=int, metavar='N',
+                        help='number of scripts evaluated at once across all '
+                             'windows (default: number of CPUs)')
+    parser.add_argument('--memory-budget', dest='memoryBudget', type=float,
+                        metavar='MB',
+                        help='largest size of the data sources of one chart, '
+                             'larger script results are rejected '
+                             '(default: no limit)')
+    parser.add_argument('--webgl-threshold', dest='webglThreshold', type=int,
+                        metavar='N',
+                        help='draw scatter traces with at least N points with '
+                             'WebGL, unless the trace meta sets "webgl": false, '
+                             '0 never switches (default: 100000)')
     parser.set_defaults(func=gui) # open gui by default
 
     subparsers = parser.add_subparsers(help='sub-command help')
@@ -64,16 +234,37 @@ def parse():
 
     runParser = subparsers.add_parser('run', help='generate chart image')
     runParser.add_argument('input', type=str, metavar='pychart-in', help='source pychart document filepath')
-    runParser.add_argument('output', type=str, metavar='image-out', help='output image filepath')
+    runParser.add_argument('output', type=str, metavar='image-out', nargs='+',
+                           help='output image filepath, the format is taken from the extension '
+                                '(png, jpg, webp or svg)')
     runParser.add_argument('--width', type=int, help='width in pixels (default: %(default)s)', default=640)
     runParser.add_argument('--height', type=int, help='height in pixels (default: %(default)s)', default=480)
+    runParser.add_argument('--size', type=parseSize, action='append', metavar='WxH',
+                           help='image size, repeat for more images from one evaluation and render, '
+                                'with one output each or one output formatted with {width} and {height}')
+    runParser.add_argument('--param', type=parseParam, action='append', default=[], metavar='KEY=VALUE',
+                           help='define a script variable, the value is read as a Python literal or else a string')
+    runParser.add_argument('--sweep', type=str, metavar='params.csv',
+                           help='export one image per row of a CSV file whose columns are script variables, '
+                                'the output path is formatted with them and {index}, e.g. chart-{region}.png')
+    runParser.add_argument('--scale', type=float, default=1,
+                           help='pixel ratio of images, e.g. 4 for print, PNG images larger than '
+                                '8192 pixels are rendered in tiles (default: %(default)s)')
+    runParser.add_argument('--headless', action='store_true',
+                           help='render with the offscreen Qt platform, the default when there is no display')
+    runParser.add_argument('--timeout', type=float, default=60, metavar='SECONDS',
+                           help='time allowed to evaluate and to render each image, after which it fails '
+                                '(default: %(default)s)')
     runParser.set_defaults(func=run)
     return parser.parse_args()
 
 
 def main():
-    init()
     args = parse()
+    profiler.enabled = args.profileStartup
+    profiler.mark('parse arguments')
+    init(args)
+    profiler.mark('start evaluator')
     args.func(args)
 
 
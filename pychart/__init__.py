@@ -0,0 +1,3 @@
+from .runtime import connection, publish
+
+__all__ = ['connection', 'publish']
@@ -1,4 +1,5 @@
 
+import collections
 import functools
 import os
 import sys
@@ -8,21 +9,44 @@ import urllib
 import multiprocessing
 
 from PyQt5.QtGui import QImage, QPixmap
-from PyQt5.QtCore import QObject, pyqtSignal, QCoreApplication, Qt, QSettings
-from PyQt5.QtWidgets import QApplication, QMessageBox, QFileDialog, QMainWindow, QAction, QDockWidget
+from PyQt5.QtCore import QObject, pyqtSignal, QCoreApplication, QEvent, Qt, QSettings, QTimer
+from PyQt5.QtWidgets import QApplication, QMessageBox, QFileDialog, QMainWindow, QAction, QActionGroup, QDockWidget, \
+                            QInputDialog
 
-from .common import readFile, writeFile, getResourcePath
+from .common import readFile, writeFile, writeFileInBackground, getResourcePath, formatBytes
 from .chart import ChartEditor, ChartEditorModel
+from .datafiles import bindingName, getFormat
+from .tiles import TILE_THRESHOLD
 from .script import ScriptEditor, ScriptConsole, ScriptEditorModel
-from .session import Session, AsyncSession
+from .evaluate import EvaluationHub, getPoolSize
+from .session import AsyncSession
+from . import jsonio
 
 APP_NAME = 'pychart'
 UNTITLED_TITLE = 'untitled'
 CHART_EXT = '.cht'
 IMAGE_EXT = '.png'
+IMAGE_FORMATS = {
+    '.png': 'png',
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg',
+    '.webp': 'webp',
+    '.svg': 'svg',
+}
 UNTITLED_CHART_NAME = UNTITLED_TITLE + CHART_EXT
 UNTITLED_IMAGE_NAME = UNTITLED_TITLE + IMAGE_EXT
 DEFAULT_CHART_NAME = 'default' + CHART_EXT
+MAX_EXPORTS_AHEAD = 1
+INTERRUPT_MESSAGES = {
+    'interrupt': 'Script interrupted',
+    'terminate': 'Script terminated, it did not stop when interrupted',
+    'kill': 'Script killed, it did not stop when terminated',
+}
+EVALUATOR_NAMES = {
+    None: 'Default',
+    'ipython': 'IPython',
+    'exec': 'Lightweight',
+}
 
 
 
@@ -57,28 +81,276 @@ def getExampleIndex():
 
 
 
-def exportImage(documentPath, imagePath, width, height, callback):
+def getImageFormat(path):
     """
-    Create a chart from the given document and export as an image to the
-    specified image path.
+    Image format of an image path, from its extension.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    return IMAGE_FORMATS.get(ext, 'png')
+
+
+
+class ImageExporter(QObject):
+    """
+    Render documents to image files one after another with a single chart
+    editor, which stays loaded between documents. A document whose image is
+    not written within the timeout fails and the next one is started.
     """
-    document = Document.fromFile(documentPath)
+    exported = pyqtSignal(list)
+    failed = pyqtSignal(list)
+
+    def __init__(self, timeout=None, scale=1):
+        super().__init__()
+        self.scale = scale
+
+        self.queue = collections.deque()
+        self.current = None
+        self.revision = None
+        self.remaining = []
+        self.ready = False
+
+        self.loadFailed = False
+
+        self.chartEditor = ChartEditor()
+        self.chartEditor.handler.chartReady.connect(self.chartReady)
+        self.chartEditor.handler.renderComplete.connect(self.renderComplete)
+
+        # loading the chart page has the same timeout as a document
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.timedOut)
+        if timeout:
+            self.timer.start(int(timeout * 1000))
+
+    def export(self, document, outputs):
+        """
+        Queue a document with a list of (image path, width, height) outputs,
+        its images are written once earlier documents are done.
+        """
+        paths = [path for (path, width, height) in outputs]
+        if self.loadFailed:
+            self.failed.emit(paths)
+            return
+
+        self.queue.append((document, outputs))
+        self.next()
+
+    def next(self):
+        if self.current or not self.ready or not self.queue:
+            return
+
+        self.current = self.queue.popleft()
+        if self.timer.interval():
+            self.timer.start()
+
+        self.chartEditor.setModel(self.current[0].chartEditorModel)
+        self.chartEditor.dataChanged()
+        self.revision = self.chartEditor.revision
+
+    def chartReady(self):
+        self.timer.stop()
+        self.ready = True
+        self.next()
+
+    def renderComplete(self, revision):
+        # wait for the state of the current document, once
+        if self.current and revision == self.revision:
+            self.revision = None
+            self.remaining = list(self.current[1])
+            self.exportNext(self.current)
+
+    def isTiled(self, output):
+        (path, width, height) = output
+        size = max(width or 0, height or 0) * self.scale
+        return getImageFormat(path) == 'png' and size > TILE_THRESHOLD
+
+    def exportNext(self, current):
+        """
+        Request the images of the current document which fit in one render
+        at once, then each larger image in tiles.
+        """
+        if current is not self.current:
+            return  # timed out
+
+        # each render of images has the full timeout
+        if self.timer.interval():
+            self.timer.start()
+
+        direct = [o for o in self.remaining if not self.isTiled(o)]
+        tiled = [o for o in self.remaining if self.isTiled(o)]
+
+        if direct:
+            self.remaining = tiled
+            requests = [{'format': getImageFormat(path), 'width': w, 'height': h,
+                         'scale': self.scale} for (path, w, h) in direct]
+            callback = functools.partial(self.imagesReady, current, direct)
+            self.chartEditor.requestImages(callback, requests)
 
-    chartEditor = ChartEditor()
-    chartEditor.setModel(document.chartEditorModel)
+        elif tiled:
+            self.remaining = tiled[1:]
+            (path, width, height) = tiled[0]
+            callback = functools.partial(self.tiledImageReady, current)
+            self.chartEditor.requestTiledImage(callback, path, width, height, self.scale)
 
-    def imageRequestCallback(imageData):
-        writeFile(imagePath, imageData)
-        callback()
+        else:
+            (document, outputs) = current
+            self.end()
+            self.exported.emit([path for (path, width, height) in outputs])
+
+    def imagesReady(self, current, outputs, images):
+        if current is not self.current:
+            return  # timed out
 
-    def chartUpdatedCallback():
-        chartEditor.requestImage(imageRequestCallback, width, height)
+        for ((path, width, height), imageData) in zip(outputs, images):
+            writeFile(path, imageData)
 
-    chartEditor.handler.chartUpdated.connect(chartUpdatedCallback)
+        self.exportNext(current)
+
+    def tiledImageReady(self, current, ok):
+        if current is not self.current:
+            return  # timed out
+
+        if ok:
+            self.exportNext(current)
+        else:
+            (document, outputs) = current
+            self.end()
+            self.failed.emit([path for (path, width, height) in outputs])
+
+    def timedOut(self):
+        if not self.ready:
+            # the chart page did not load, so no document can be rendered
+            self.loadFailed = True
+            while self.queue:
+                outputs = self.queue.popleft()[1]
+                self.failed.emit([path for (path, width, height) in outputs])
+            return
+
+        (document, outputs) = self.current
+        self.end()
+        self.failed.emit([path for (path, width, height) in outputs])
+
+    def end(self):
+        self.chartEditor.cancelTiledImage()
+        self.timer.stop()
+        (self.current, self.revision) = (None, None)
+        QTimer.singleShot(0, self.next)
+
+
+
+def exportImages(documentPath, variants, callback, timeout=None, scale=1):
+    """
+    Create charts from the given document and export images of each. Each
+    variant is a (params, outputs) tuple, where the params are defined as
+    variables of the script and outputs is a list of (image path, width,
+    height) tuples rendered from one evaluation and chart layout, with the
+    pixel size of images multiplied by scale. PNG images larger than the
+    chart can render at once are rendered in tiles. Scripts are evaluated
+    concurrently by the evaluation hub, at most as many at once as it has
+    processes, and charts are rendered as their results arrive. Evaluating
+    and rendering each have the timeout in seconds. The callback is passed
+    the number of variants which failed.
+
+    At most MAX_EXPORTS_AHEAD more documents than the pool has processes
+    are evaluated or wait to be rendered at once, so evaluations wait for
+    rendering when scripts are faster than the chart, rather than keeping
+    every document in memory.
+    """
+    if not variants:
+        # the caller's event loop may not run yet
+        QTimer.singleShot(0, lambda: callback(0))
+        return None
+
+    exporter = ImageExporter(timeout, scale)
+    waiting = collections.deque(variants)
+    remaining = len(variants)
+    (active, failures) = (0, 0)
+
+    # keep the hub's processes while evaluations wait for rendering
+    hub = EvaluationHub.instance()
+    keepAlive = hub.register()
+
+    def finish(failed):
+        nonlocal remaining, active, failures
+        remaining -= 1
+        active -= 1
+        failures += failed
+        if remaining:
+            dispatch()
+        else:
+            hub.unregister(keepAlive)
+            callback(failures)
+
+    def failed(paths, reason):
+        print(f'Error: {", ".join(paths)} not exported, {reason}', file=sys.stderr)
+        finish(True)
+
+    exporter.exported.connect(lambda paths: finish(False))
+    exporter.failed.connect(lambda paths: failed(paths, 'rendering failed'))
+
+    def dispatch():
+        while waiting and active < getPoolSize() + MAX_EXPORTS_AHEAD:
+            evaluate()
+
+    def evaluate():
+        nonlocal active
+        active += 1
+
+        (params, outputs) = waiting.popleft()
+        paths = [path for (path, width, height) in outputs]
+        document = Document.fromFile(documentPath)
+        session = AsyncSession(exporter)
+        session.setDocument(document)
+        session.setParams(params)
+
+        timer = QTimer(session)
+        timer.setSingleShot(True)
+        (rejected, ended) = ([], [])
+
+        def end(reason=None):
+            # signals queued before the session was stopped may still arrive
+            if ended:
+                return
+            ended.append(True)
+
+            timer.stop()
+            session.stop()
+
+            if reason:
+                failed(paths, reason)
+            elif rejected:
+                failed(paths, 'the data sources exceed the memory budget')
+            else:
+                exporter.export(document, outputs)
+
+            # the session, its timer and their connections would otherwise
+            # keep the document until the whole export ends
+            session.deleteLater()
+
+        session.updateStdout.connect(sys.stdout.write)
+        session.updateErrored.connect(lambda: end('the script failed'))
+        session.updateSucceeded.connect(lambda: end())
+        document.chartEditorModel.memoryBudgetExceeded.connect(
+            lambda nbytes, budget: rejected.append(nbytes))
+        timer.timeout.connect(lambda: end('the script timed out'))
+
+        session.start()
+        session.update()
+        if timeout:
+            timer.start(int(timeout * 1000))
+
+    dispatch()
+    return exporter
+
+
+def exportImage(documentPath, imagePath, width, height, callback):
+    """
+    Create a chart from the given document and export as an image to the
+    specified image path.
+    """
+    return exportImages(documentPath, [({}, [(imagePath, width, height)])],
+                        lambda failures: callback())
 
-    session = Session()
-    session.setDocument(document)
-    session.update()
 
 
 class DocumentParseError(Exception):
@@ -129,14 +401,13 @@ class Document(QObject):
         self.filepath = filepath
         self.isModified = False
 
-        with open(filepath, 'w') as f:
-            json.dump(data, f, indent=1)
+        writeFile(filepath, jsonio.dumps(data, indent=True).encode())
 
     @classmethod
     def fromFile(cls, filepath, template=False):
 
         try:
-            data = json.loads(readFile(filepath))
+            data = jsonio.loads(readFile(filepath))
             instance = cls.unserialize(data)
         except KeyError as e:
             msg = f"Document missing key: {e.args[0]}"
@@ -177,8 +448,9 @@ class MainWindow(QMainWindow):
         self.scriptEditor = ScriptEditor()
         self.scriptConsole = ScriptConsole()
 
-        # listen for update errors
+        # listen for update errors and interruptions
         self.session.updateErrored.connect(self.onEvaluationError)
+        self.session.updateInterrupted.connect(self.onEvaluationInterrupted)
 
         # session listens to script editor buttons
         self.scriptEditor.startEvaluation.connect(self.startEvaluation)
@@ -243,6 +515,14 @@ class MainWindow(QMainWindow):
         super().closeEvent(event)
 
 
+    def changeEvent(self, event):
+        # evaluations of the active window run before those of other windows
+        if event.type() == QEvent.ActivationChange and self.isActiveWindow():
+            self.session.focus()
+
+        super().changeEvent(event)
+
+
     def storeWindowSettings(self):
         self.settings.setValue("geometry", self.saveGeometry())
         self.settings.setValue("windowState", self.saveState())
@@ -323,11 +603,39 @@ class MainWindow(QMainWindow):
         actn.triggered.connect(self.startEvaluation)
         menu.addAction(actn)
 
+        actn = QAction("Execute All Cells", self)
+        actn.setShortcut('Ctrl+Shift+Return')
+        actn.triggered.connect(self.startFullEvaluation)
+        menu.addAction(actn)
+
         actn = QAction("Stop", self)
         actn.setShortcut('Shift+Delete')
         actn.triggered.connect(self.stopEvaluation)
         menu.addAction(actn)
 
+        menu.addSeparator()
+
+        actn = QAction("Add Script Section...", self)
+        actn.triggered.connect(self.addScriptSection)
+        menu.addAction(actn)
+
+        actn = QAction("Add Data File...", self)
+        actn.triggered.connect(self.addDataFile)
+        menu.addAction(actn)
+
+        menu.addSeparator()
+
+        # evaluator used for this document's script
+        submenu = menu.addMenu("Evaluator")
+        self.evaluatorActionGroup = group = QActionGroup(self)
+        for evaluator, name in EVALUATOR_NAMES.items():
+            actn = QAction(name, self)
+            actn.setCheckable(True)
+            actn.setData(evaluator)
+            actn.triggered.connect(functools.partial(self.setEvaluator, evaluator))
+            group.addAction(actn)
+            submenu.addAction(actn)
+
         ## chart menu ###
         menu = mb.addMenu("Chart")
 
@@ -341,8 +649,19 @@ class MainWindow(QMainWindow):
         actn.triggered.connect(self.requestExportToClipboard)
         menu.addAction(actn)
 
-        ## examples menu
+        ## examples menu (populated when first shown)
         menu = mb.addMenu("Examples")
+        menu.aboutToShow.connect(self.populateExamplesMenu)
+        self.examplesMenu = menu
+
+
+    def populateExamplesMenu(self):
+        """
+        Fill the examples menu from the example index on first use.
+        """
+        menu = self.examplesMenu
+        if not menu.isEmpty():
+            return
 
         for name, path in getExampleIndex().items():
             actn = QAction(name, self)
@@ -378,18 +697,116 @@ class MainWindow(QMainWindow):
     def startEvaluation(self):
         # reset the console for new evaluation
         self.scriptConsole.clear()
-        self.session.update()
+        if self.checkSyntax():
+            self.session.update()
+
+
+    def startFullEvaluation(self):
+        """
+        Evaluate every cell of the script, including unchanged cells, e.g. to
+        read data which changed since the last evaluation.
+        """
+        self.scriptConsole.clear()
+        if self.checkSyntax():
+            self.session.update(reuseCells=False)
+
+
+    def checkSyntax(self):
+        """
+        Check the scripts for syntax errors before they are evaluated, so
+        typos are reported without starting an evaluation. Errors are marked
+        in the editor and shown in the console.
+        """
+        evaluator = self.document.scriptEditorModel.getEvaluator()
+        errors = self.scriptEditor.checkSyntax(evaluator)
+
+        for (name, error) in errors:
+            message = ''.join(traceback.format_exception_only(type(error), error))
+            self.scriptConsole.insertAnsiText(f'{name}:\n{message}')
+
+        if errors:
+            self.onEvaluationError()
+
+        return not errors
 
 
     def stopEvaluation(self):
         self.session.interrupt()
 
 
+    def setEvaluator(self, evaluator):
+        self.document.scriptEditorModel.setEvaluator(evaluator)
+
+
+    def addScriptSection(self):
+        """
+        Add a named script section, which is evaluated at the same time as
+        the script and other sections.
+        """
+        model = self.document.scriptEditorModel
+        names = [section['name'] for section in model.getSections()]
+
+        (name, ok) = QInputDialog.getText(self, 'Add Script Section', 'Section name:')
+        name = name.strip()
+        if not ok or not name:
+            return
+
+        if name in names or name in ('Script', 'Setup'):
+            QMessageBox.warning(self, 'Add Script Section', f'A section named "{name}" already exists.')
+            return
+
+        model.setSections(model.getSections() + [{'name': name, 'script': model.DEFAULT_SCRIPT}])
+        self.scriptEditor.showSection(name)
+
+
+    def addDataFile(self):
+        """
+        Bind a data file to a script variable named after the file.
+        """
+        filters = 'Data files (*.npy *.arrow *.feather *.csv);;All files (*)'
+        (path, _) = QFileDialog.getOpenFileName(self, 'Add Data File', '', filters)
+        if not path:
+            return
+
+        # paths are stored relative to a saved document
+        if self.document.filepath:
+            path = os.path.relpath(path, os.path.dirname(self.document.filepath))
+
+        model = self.document.scriptEditorModel
+        binding = {'name': bindingName(path), 'path': path, 'format': getFormat(path)}
+        model.setBindings(model.getBindings() + [binding])
+        self.scriptConsole.insertAnsiText(
+            f'\nData file {path} is available to the script as {binding["name"]}.\n')
+
+
+    def refreshEvaluatorActions(self):
+        evaluator = self.document.scriptEditorModel.getEvaluator()
+        for actn in self.evaluatorActionGroup.actions():
+            actn.setChecked(actn.data() == evaluator)
+
+
     def onEvaluationError(self):
         if self.showConsoleOnError:
             self.scriptConsoleDockWidget.setVisible(True)
 
 
+    def onEvaluationInterrupted(self, stage):
+        self.scriptConsole.insertAnsiText(f'\n{INTERRUPT_MESSAGES[stage]}\n')
+
+
+    def onMemoryBudgetExceeded(self, nbytes, budget):
+        self.scriptConsole.insertAnsiText(
+            f'\nError: Data sources use {formatBytes(nbytes)}, more than the '
+            f'memory budget of {formatBytes(budget)}, and were not updated.\n')
+        if self.showConsoleOnError:
+            self.scriptConsoleDockWidget.setVisible(True)
+
+
+    def refreshSourceSizes(self):
+        sizes = self.document.chartEditorModel.getChartDataSourceSizes()
+        self.scriptEditor.setSourceSizes(sizes)
+
+
     def getDocument(self):
         return self.document
 
@@ -400,6 +817,11 @@ class MainWindow(QMainWindow):
         self.chartEditor.setModel(self.document.chartEditorModel)
         self.scriptEditor.setModel(self.document.scriptEditorModel)
         self.document.wasModified.connect(self.documentWasModified)
+        self.document.chartEditorModel.dataChanged.connect(self.refreshSourceSizes)
+        self.document.chartEditorModel.memoryBudgetExceeded.connect(
+            self.onMemoryBudgetExceeded)
+        self.refreshEvaluatorActions()
+        self.refreshSourceSizes()
         self.scriptConsole.clear()
 
 
@@ -538,7 +960,7 @@ class MainWindow(QMainWindow):
         if not path:
             return
 
-        writeFile(path, imageData)
+        writeFileInBackground(path, imageData)
 
 
     def exportImageToClipboard(self, imageData):
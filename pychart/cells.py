@@ -0,0 +1,352 @@
+"""
+Incremental evaluation of scripts split into cells by '# %%' lines.
+
+Each cell has a key made from its code, the keys of the earlier cells it
+shares variable names with, the values of the params, setup variables and
+data files it uses, and the context of its job: the session evaluating it,
+the document's connections and the stamps of its data files. After a cell
+runs, the variables it changed are kept by its key, so evaluating the script
+again only runs cells whose key changed, an edited cell and the cells after
+it which use its variables, and restores the variables of the others.
+
+Variables are kept and restored as they are, without copies. A cell may
+change a variable of an earlier cell in place, so a cheap fingerprint is
+taken of the variables which later cells of a run use. A variable changed by
+a cell is kept with that cell too, and the earlier cell is not kept.
+Variables which can't be fingerprinted, such as open files and instances of
+most classes, are assumed to be changed by any later cell using them.
+
+This module is loaded by evaluation processes, so it must not import Qt.
+"""
+import array
+import ast
+import collections
+import hashlib
+import itertools
+import re
+import sys
+import types
+import zlib
+
+# line starting a new cell
+CELL_MARKER = re.compile(r'^#\s*%%', re.MULTILINE)
+
+# number of cell results kept by a process
+CELL_CACHE_SIZE = 64
+
+# approximate number of bytes of cell variables kept by a process
+CELL_CACHE_BYTES = 512 * 1024 * 1024
+
+# types of variables keyed by value rather than by identity
+VALUE_TYPES = (type(None), bool, int, float, complex, str, bytes)
+
+# types of variables which are rarely changed in place
+STABLE_TYPES = (type, types.FunctionType, types.BuiltinFunctionType,
+                types.MethodType, types.ModuleType, range)
+
+# changed variables, removed variables, result, objects keyed by identity and
+# size of cells by key, least recently used first
+_cells = collections.OrderedDict()
+
+# total size of the cells kept
+_cellBytes = 0
+
+
+
+class Cell:
+    """
+    Cell of a script, with the names of variables it assigns and uses. The
+    names are None if the cell is not valid Python, e.g. uses IPython magics,
+    in which case it is assumed to use every variable.
+    """
+    def __init__(self, source, line):
+        self.source = source
+        self.line = line
+        self.key = None
+        self.refs = []
+        self.needed = None
+        (self.stores, self.loads) = cellNames(source)
+
+    def padded(self):
+        """
+        Source of the cell with the lines before it left empty, so line
+        numbers in tracebacks are lines of the script.
+        """
+        return '\n' * self.line + self.source
+
+    def ipythonSource(self):
+        """
+        Source of the cell for IPython. Cell magics must start the source, so
+        a cell starting with one is run without its marker line and the empty
+        lines around it, and tracebacks show lines of the cell instead.
+        """
+        body = self.source
+        if CELL_MARKER.match(body):
+            body = body.partition('\n')[2]
+
+        body = body.lstrip('\n')
+        return body if body.startswith('%%') else self.padded()
+
+    def names(self):
+        if self.loads is None:
+            return None
+
+        return self.stores | self.loads
+
+
+
+def cellNames(source):
+    """
+    Return the (stores, loads) sets of the variable names a cell assigns and
+    the names it uses, or (None, None) if it can't be parsed.
+    """
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return (None, None)
+
+    (stores, loads) = (set(), set())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            (loads if isinstance(node.ctx, ast.Load) else stores).add(node.id)
+
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            stores.add(node.name)
+
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                stores.add(alias.asname or alias.name.split('.')[0])
+
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            stores.update(node.names)
+
+    return (stores, loads)
+
+
+def splitCells(script):
+    """
+    Split a script at '# %%' lines into cells, or return None if the script
+    has no cell markers.
+    """
+    starts = [m.start() for m in CELL_MARKER.finditer(script)]
+    if not starts:
+        return None
+
+    if starts[0] != 0:
+        starts.insert(0, 0)
+
+    ends = starts[1:] + [len(script)]
+    return [Cell(script[start:end], script.count('\n', 0, start))
+            for (start, end) in zip(starts, ends)]
+
+
+def valueKey(value):
+    if isinstance(value, VALUE_TYPES):
+        return repr(value)
+
+    # other objects, such as setup variables and data files, are kept by the
+    # process and are the same object while they are unchanged. Cached cells
+    # keep a reference to them, so their ids can't be reused by new objects
+    return f'id:{id(value)}'
+
+
+def keyCells(cells, variables, evaluator, context=''):
+    """
+    Set the key of each cell, where variables are the variables defined
+    before the first cell and context describes anything else the cells may
+    depend on. A cell depends on the earlier cells sharing names with it,
+    and on the earlier cells sharing names with those, e.g. the cell setting
+    a variable read by a function the cell calls.
+    """
+    stored = set()
+    for (index, cell) in enumerate(cells):
+        parts = [evaluator, context, cell.source]
+
+        (needed, depends) = (cell.names(), set())
+        grown = True
+        while grown:
+            grown = False
+            for (other, earlier) in enumerate(cells[:index]):
+                names = earlier.names()
+                if other in depends or not (needed is None or names is None or needed & names):
+                    continue
+
+                depends.add(other)
+                needed = None if needed is None or names is None else needed | earlier.loads
+                grown = True
+
+        parts.extend(cells[other].key for other in sorted(depends))
+        cell.needed = needed
+
+        # variables defined before the first cell which the cell uses
+        used = variables if cell.loads is None else (cell.loads - stored) & set(variables)
+        parts.extend(f'{name}={valueKey(variables[name])}' for name in sorted(used))
+        cell.refs = [variables[name] for name in used
+                     if not isinstance(variables[name], VALUE_TYPES)]
+
+        cell.key = hashlib.sha1('\0'.join(parts).encode()).hexdigest()
+        stored |= cell.stores or set()
+
+
+def isShared(value):
+    """
+    Whether a variable can't be changed in place and is owned by something
+    other than the cell: modules, and read only arrays such as the columns of
+    data files.
+    """
+    if isinstance(value, types.ModuleType):
+        return True
+
+    flags = getattr(value, 'flags', None)
+    return getattr(flags, 'writeable', True) is False
+
+
+def fingerprint(value):
+    """
+    Cheap digest of a variable which changes when the variable is changed in
+    place, or None if there is none. Changes inside objects other than
+    containers and arrays which are held by a container aren't seen.
+    """
+    if isinstance(value, VALUE_TYPES + STABLE_TYPES) or isShared(value):
+        return 0
+
+    if isinstance(value, (list, tuple, dict)):
+        items = tuple(value.items() if isinstance(value, dict) else value)
+        try:
+            return hash(items)
+        except TypeError:
+            prints = tuple(map(fingerprint, items))
+            return None if None in prints else hash(prints)
+
+    if isinstance(value, (set, frozenset)):
+        return hash(frozenset(value))
+
+    if isinstance(value, (bytearray, array.array)):
+        return zlib.crc32(value)
+
+    # numpy arrays, and objects which convert to them such as data frames
+    if hasattr(value, '__array__'):
+        try:
+            return zlib.crc32(value.__array__().tobytes())
+        except Exception:
+            return None
+
+    if type(value).__hash__ in (None, object.__hash__):
+        return None
+
+    try:
+        return hash(value)
+    except TypeError:
+        return None
+
+
+def approximateSize(value):
+    """
+    Approximate number of bytes used by a variable, estimated from a sample
+    of the items of containers.
+    """
+    if isShared(value):
+        return 0
+
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+
+    size = sys.getsizeof(value, 0)
+    if isinstance(value, (list, tuple, set, frozenset, dict)) and value:
+        items = value.values() if isinstance(value, dict) else value
+        sample = list(itertools.islice(items, 100))
+        size += len(value) * sum(map(approximateSize, sample)) // len(sample)
+
+    return size
+
+
+def dropCell(key):
+    global _cellBytes
+    entry = _cells.pop(key, None)
+    if entry is not None:
+        _cellBytes -= entry[4]
+
+
+def keepCell(key, changed, removed, result, refs):
+    """
+    Keep what a cell changed by its key, unless it's larger than the cache.
+    """
+    global _cellBytes
+    dropCell(key)
+    size = sum(map(approximateSize, changed.values())) + approximateSize(result)
+    if size > CELL_CACHE_BYTES:
+        return
+
+    _cells[key] = (changed, removed, result, refs, size)
+    _cellBytes += size
+    while len(_cells) > CELL_CACHE_SIZE or _cellBytes > CELL_CACHE_BYTES:
+        dropCell(next(iter(_cells)))
+
+
+def runCells(cells, namespace, runCell, reuse=True):
+    """
+    Evaluate cells in namespace with runCell, which is passed a cell and
+    returns a (result, exception) tuple. If reuse is set, cells whose key was
+    seen before restore the variables they changed instead of running.
+    Returns the (result, exception) of the last cell, or of the first cell
+    which failed.
+    """
+    missing = object()
+    result = None
+
+    runs = [not (reuse and cell.key in _cells) for cell in cells]
+
+    # names used by the cells which run after each cell, None for any name
+    (later, laterNames) = (set(), [])
+    for (cell, run) in zip(reversed(cells), reversed(runs)):
+        laterNames.insert(0, later)
+        if run and later is not None:
+            later = None if cell.needed is None else later | cell.needed
+
+    # fingerprints of the variables of kept cells which later cells use, and
+    # the cells whose variables changed since they were kept
+    (watched, stale) = ([], set())
+    try:
+        for (cell, run, names) in zip(cells, runs, laterNames):
+            if run:
+                before = dict(namespace)
+                (result, error) = runCell(cell)
+                if error:
+                    return (None, error)
+
+                changed = {k: v for (k, v) in namespace.items()
+                           if before.get(k, missing) is not v and not k.startswith('__')}
+                removed = [k for k in before if k not in namespace]
+
+                # variables of earlier cells the cell changed in place are
+                # also restored with it
+                for (key, kept, prints) in watched:
+                    for (k, p) in prints.items():
+                        if cell.needed is not None and k not in cell.needed:
+                            continue
+
+                        now = fingerprint(kept[k])
+                        if p is None or now != p:
+                            prints[k] = now
+                            stale.add(key)
+                            if namespace.get(k, missing) is kept[k]:
+                                changed.setdefault(k, kept[k])
+
+                keepCell(cell.key, changed, removed, result, cell.refs)
+            else:
+                _cells.move_to_end(cell.key)
+                (changed, removed, result) = _cells[cell.key][:3]
+                namespace.update(changed)
+                for name in removed:
+                    namespace.pop(name, None)
+
+            used = changed.keys() if names is None else changed.keys() & names
+            if used:
+                watched.append((cell.key, changed, {k: fingerprint(changed[k]) for k in used}))
+
+        return (result, None)
+
+    finally:
+        for key in stale:
+            dropCell(key)
@@ -1,6 +1,6 @@
 
 import copy
-import simplejson as json
+import itertools
 import sys
 import os
 import random
@@ -13,6 +13,9 @@ from PyQt5.QtCore import Qt, QObject, QJsonValue, pyqtSignal, pyqtSlot
 from PyQt5.QtWebChannel import QWebChannel
 
 from .common import disconnectSignal, debugClassMethod, getResourcePath
+from .sources import SourceStore, columnsEqual, getMemoryBudget
+from . import jsonio
+from .tiles import TiledImageExport
 
 ## debug chart
 # import os
@@ -20,6 +23,31 @@ from .common import disconnectSignal, debugClassMethod, getResourcePath
 
 from pprint import pprint
 
+# trace types drawn with WebGL instead of SVG when they have many points
+WEBGL_TYPES = {
+    'scatter': 'scattergl',
+    'scatterpolar': 'scatterpolargl',
+}
+
+# trace attributes counted as the points of a trace
+WEBGL_COORDINATES = ('x', 'y', 'r', 'theta')
+
+_webglThreshold = 100000
+
+
+def setWebGLThreshold(points):
+    """
+    Set the number of points from which traces are drawn with WebGL, or None
+    to never switch.
+    """
+    global _webglThreshold
+    _webglThreshold = points
+
+
+def getWebGLThreshold():
+    return _webglThreshold
+
+
 def cleanLayout(layout):
     """
     Remove unneccesary data from layout.
@@ -38,128 +66,86 @@ def cleanLayout(layout):
 
 
 
-def removeSourcesFromTraces(traces):
+def patchLayout(layout, patch):
     """
-    Remove source data from chart traces data.
-
-    not yet defined:
-    {'mode': 'markers', 'type': 'scatter'}
-
-    simple:
-    {
-      'meta': {'columnNames': {'x': 'inc'}},
-      'x': [],
-      'xsrc': 'inc'
-    }
-
-    extra data (header, marker, etc)
-    {
-      'header': {'fill': {'color': [], 'colorsrc': 'inc'}},
-      'meta': {'columnNames': {'header': {'fill': {'color': 'inc'}}}},
-    }
-
-
-    {
-        'cells': {'values': [[],[]],
-                 'valuessrc': ['sin', 'rand']},
-        'header': {'values': [],
-                 'valuessrc': 'inc'},
-        'meta': {'columnNames': {'cells': {'values': 'sin - rand'},
-                               'header': {'values': 'inc'}}
-    }
-
-    {
-        'cells': {},
-        'header': {},
-        'meta': {'columnNames': {'cells': {'values': ''},
-                                'header': {'values': ''}}
-    },
+    Apply a patch of top-level layout keys to set and unset to a copy of the
+    layout.
     """
-    def delete(a, b):
-        for k,v in a.items():
-            if type(v) is dict:
-                delete(v, b[k])
+    res = dict(layout)
+    res.update(patch['set'])
+    for k in patch['unset']:
+        res.pop(k, None)
+
+    return res
+
 
-            elif type(v) is str:
-                # skip unset source name
-                if not v:
-                    continue
 
-                del b[k]
-            else:
-                assert(False)
+def upgradeTracesToWebGL(traces, dataSources, threshold):
+    """
+    Switch traces to their WebGL type if a source bound to their coordinates
+    has at least threshold points. The original type is kept in the trace meta
+    so the switch can be reverted, traces with a false 'webgl' meta opt out.
+    """
+    def points(trace, key):
+        src = trace.get(key + 'src')
+        if type(src) is str and hasattr(dataSources.get(src), '__len__'):
+            return len(dataSources[src])
+        return 0
 
-    # strip values from data
     for trace in traces:
-        # if trace sources are not yet defined
-        if 'meta' not in trace:
+        # meta may be any value, only dicts are used by pychart
+        meta = trace.get('meta')
+        if not isinstance(meta, dict) or meta.get('webgl', True) is False:
+            continue
+
+        if trace.get('type') not in WEBGL_TYPES:
             continue
 
-        delete(trace['meta']['columnNames'], trace)
+        if max(points(trace, k) for k in WEBGL_COORDINATES) >= threshold:
+            meta['webglFrom'] = trace['type']
+            trace['type'] = WEBGL_TYPES[trace['type']]
 
 
 
-def insertSourcesIntoTraces(traces, dataSources):
+def revertWebGLTraces(traces):
     """
-    Insert sources in to trace data.
+    Restore the types of traces switched to WebGL by upgradeTracesToWebGL. A
+    trace changed back to its original type in the editor opts out of being
+    switched again, returns True if any trace opted out.
     """
-    def insert(a, b):
-        for k,v in a.items():
-            if type(v) is dict:
-                insert(v, b[k])
-
-            # if v is a source title
-            elif type(v) is str:
-                # skip if not set
-                if not v:
-                    continue
-
-                # get data source
-                src = b[k + 'src']
-
-                # if single data source
-                if type(src) is str:
-                    if src in dataSources:
-                        b[k] = dataSources[src]
-
-                    else: # source not found
-                        a[k] = ''
-
-                # else if multiple data sources
-                elif type(src) is list:
-                    # if any data sources match
-                    if set(src).intersection(dataSources.keys()):
-                        b[k] = [dataSources[s] for s in src if s in dataSources]
-                    else:
-                        a[k] = ''
-
-                else:
-                    assert(False)
-
-            else:
-                assert(False)
-
-    # strip values from data
+    optedOut = False
     for trace in traces:
-        # if trace sources are not yet defined
-        if 'meta' not in trace:
+        meta = trace.get('meta')
+        if not isinstance(meta, dict) or 'webglFrom' not in meta:
             continue
 
-        insert(trace['meta']['columnNames'], trace)
+        original = meta.pop('webglFrom')
+        if trace.get('type') == WEBGL_TYPES[original]:
+            trace['type'] = original
+
+        elif trace.get('type') == original:
+            meta['webgl'] = False
+            optedOut = True
+
+    return optedOut
 
 
 
 class WebCallHandler(QObject):
     # python -> javascript
     updateChartStateSignal = pyqtSignal(str)
-    requestImageSignal = pyqtSignal(int, int)
+    requestImagesSignal = pyqtSignal(str)
+    prepareTilesSignal = pyqtSignal(str)
+    requestTileSignal = pyqtSignal(str)
 
     # javscript -> python signals
     chartReady = pyqtSignal()
-    chartUpdated = pyqtSignal()
+    renderComplete = pyqtSignal(int)
     dataChanged = pyqtSignal(list)
     layoutChanged = pyqtSignal(dict)
-    imageReady = pyqtSignal(str)
+    imagesReady = pyqtSignal(list)
+    tilesPrepared = pyqtSignal(bool)
+    tileReady = pyqtSignal(bytes)
 
     def __init__(self):
         super().__init__()
@@ -170,13 +156,28 @@ class WebCallHandler(QObject):
     def updateChartState(self, data):
         """Wrap signal to convert python data to json"""
         assert(self.editorHasMounted)
-        jsn = json.dumps(data, iterable_as_array=True)
+        jsn = jsonio.dumps(data)
         self.updateChartStateSignal.emit(jsn);
 
-    def requestImage(self, width, height):
-        width = width if width else 0
-        height = height if height else 0
-        self.requestImageSignal.emit(width, height)
+    def requestImages(self, requests):
+        """
+        Request images as a list of dicts with the format, width and height,
+        a size of 0 uses the size of the chart.
+        """
+        self.requestImagesSignal.emit(jsonio.dumps(requests))
+
+    def prepareTiles(self, width, height):
+        """
+        Render the chart as SVG at the given size to rasterize tiles from.
+        """
+        self.prepareTilesSignal.emit(jsonio.dumps({'width': width, 'height': height}))
+
+    def requestTile(self, tile):
+        """
+        Request a tile of the prepared chart as a dict with the x, y, width
+        and height in pixels of the image scaled by scale.
+        """
+        self.requestTileSignal.emit(jsonio.dumps(tile))
 
 
     # javascript -> python
@@ -185,22 +186,34 @@ class WebCallHandler(QObject):
         self.editorHasMounted = True
         self.chartReady.emit()
 
-    @pyqtSlot()
-    def emitChartUpdated(self):
-        self.chartUpdated.emit()
+    # revision of the state the chart has finished drawing
+    @pyqtSlot(int)
+    def emitRenderComplete(self, revision):
+        self.renderComplete.emit(revision)
 
+    # traces are sent without the source data
     @pyqtSlot(str)
     def dataChangedJson(self, jsn):
-        self.dataChanged.emit(json.loads(jsn));
+        self.dataChanged.emit(jsonio.loads(jsn));
 
+    # patch of changed top-level layout keys
     @pyqtSlot(str)
     def layoutChangedJson(self, jsn):
-        self.layoutChanged.emit(json.loads(jsn));
+        self.layoutChanged.emit(jsonio.loads(jsn));
 
 
+    # data urls of the requested images
     @pyqtSlot(str)
-    def emitImageReady(self, dataUrl):
-        self.imageReady.emit(dataUrl)
+    def emitImagesReady(self, jsn):
+        self.imagesReady.emit(jsonio.loads(jsn))
+
+    @pyqtSlot(bool)
+    def emitTilesPrepared(self, ok):
+        self.tilesPrepared.emit(ok)
+
+    @pyqtSlot(str)
+    def emitTileReady(self, dataUrl):
+        self.tileReady.emit(urllib.request.urlopen(dataUrl).read())
 
 
 
@@ -210,15 +223,22 @@ class ChartEditorModel(QObject):
     dataChanged = pyqtSignal()
     wasModified = pyqtSignal()
 
+    # bytes the rejected sources would use, and the budget
+    memoryBudgetExceeded = pyqtSignal(object, object)
+
     def __init__(self, data=None):
         super().__init__()
 
         self.data = data or {
-            'dataSources': {},
+            'dataSources': SourceStore(),
             'data': [],
             'layout': {},
         }
 
+        # revision of each source, which changes whenever its values change
+        self.revisions = itertools.count(1)
+        self.sourceRevisions = {}
+
     def serialize(self):
         return {
             '_version_': self.VERSION,
@@ -229,7 +249,7 @@ class ChartEditorModel(QObject):
     @classmethod
     def unserialize(cls, data):
         res = {
-            'dataSources': {},
+            'dataSources': SourceStore(),
             'data': data['data'],
             'layout': data['layout'],
         }
@@ -241,10 +261,44 @@ class ChartEditorModel(QObject):
 
     # @debugClassMethod
     def setChartDataSources(self, dataSources):
-        if self.data['dataSources'] != dataSources:
-            self.data['dataSources'] = dataSources
+        """
+        Store sources as typed columns. Sources using more than the memory
+        budget are rejected and the current sources are kept.
+        """
+        store = SourceStore(dataSources)
+
+        budget = getMemoryBudget()
+        if budget is not None and store.nbytes() > budget:
+            self.memoryBudgetExceeded.emit(store.nbytes(), budget)
+            return
+
+        old = self.data['dataSources']
+        revision = next(self.revisions)
+        revisions = {
+            name: self.sourceRevisions[name]
+                  if name in old and columnsEqual(old[name], values)
+                  else revision
+            for name, values in store.items()
+        }
+
+        if revisions != self.sourceRevisions:
+            self.data['dataSources'] = store
+            self.sourceRevisions = revisions
             self.dataChanged.emit()
 
+    def getChartDataSourceRevisions(self):
+        """
+        Revision of each data source, sources keep their revision while their
+        values are unchanged.
+        """
+        return self.sourceRevisions
+
+    def getChartDataSourceSizes(self):
+        """
+        Bytes used by each data source.
+        """
+        return self.data['dataSources'].sizes()
+
     def getChartData(self):
         return self.data['data']
 
@@ -273,12 +327,19 @@ class ChartEditor(QtWebEngineWidgets.QWebEngineView):
 
         # init queue
         self.imageRequestCallbackQueue = Queue()
+        self.tiledExport = None
 
         # disable context menu
         self.setContextMenuPolicy(Qt.NoContextMenu)
 
         # keep references to make sure they don't get destroyed
         self.model = None
+
+        # source revisions the chart has received
+        self.sentRevisions = {}
+
+        # revision of the last state sent to the chart
+        self.revision = 0
         self.handler = WebCallHandler()
         self.channel = QWebChannel()
         self.channel.registerObject('handler', self.handler)
@@ -287,7 +348,7 @@ class ChartEditor(QtWebEngineWidgets.QWebEngineView):
         self.handler.chartReady.connect(self.chartReady)
         self.handler.dataChanged.connect(self.chartDataChanged)
         self.handler.layoutChanged.connect(self.chartLayoutChanged)
-        self.handler.imageReady.connect(self.imageReady)
+        self.handler.imagesReady.connect(self.imagesReady)
 
         # load react page and set web channel
         url = 'file://' + getResourcePath('react/index.html')
@@ -300,25 +361,48 @@ class ChartEditor(QtWebEngineWidgets.QWebEngineView):
         Set the model and connect signals, but do not emit a data change event
         because a script evaluation will cause the data to update anyway.
         """
+        if self.model:
+            self.model.dataChanged.disconnect(self.dataChanged)
+
         self.model = model
         self.model.dataChanged.connect(self.dataChanged)
+        self.sentRevisions = {}
         # self.dataChanged()
 
     def dataChanged(self):
         """
-        Model has changed
+        Model has changed. Only sources whose revision the chart does not have
+        are sent, the chart keeps the others and inserts them into the traces.
         """
         # only update if component has mounted
         if self.handler.editorHasMounted:
-            data = copy.deepcopy(self.model.data)
-            insertSourcesIntoTraces(data['data'], data['dataSources'])
+            sources = self.model.getChartDataSources()
+            revisions = dict(self.model.getChartDataSourceRevisions())
+            changed = {name: sources[name] for name, rev in revisions.items()
+                       if self.sentRevisions.get(name) != rev}
+
+            self.revision += 1
+            data = {
+                'revision': self.revision,
+                'dataSources': changed,
+                'revisions': revisions,
+                'data': copy.deepcopy(self.model.getChartData()),
+                'layout': self.model.getChartLayout(),
+            }
+
+            threshold = getWebGLThreshold()
+            if threshold:
+                upgradeTracesToWebGL(data['data'], sources, threshold)
+
             self.handler.updateChartState(data);
+            self.sentRevisions = revisions
 
 
     def chartReady(self):
         """
         Chart has mounted on Javascript side, so update chart state
         """
+        self.sentRevisions = {}
         if self.model:
             self.dataChanged()
 
@@ -329,14 +413,20 @@ class ChartEditor(QtWebEngineWidgets.QWebEngineView):
         """
         # ignore model changed signal when change comes from the view
         with disconnectSignal(self.model.dataChanged, self.dataChanged):
-            removeSourcesFromTraces(data)
+            optedOut = revertWebGLTraces(data)
             self.model.setChartData(data)
 
+        # the chart still has the switch marker of an opted out trace
+        if optedOut:
+            self.dataChanged()
+
 
-    def chartLayoutChanged(self, layout):
+    def chartLayoutChanged(self, patch):
         """
-        Javascript signals model changes
+        Javascript signals model changes, as the changed top-level keys
         """
+        layout = patchLayout(self.model.getChartLayout(), patch)
+
         # ignore model changed signal when change comes from the view
         with disconnectSignal(self.model.dataChanged, self.dataChanged):
             cleanLayout(layout)
@@ -344,11 +434,40 @@ class ChartEditor(QtWebEngineWidgets.QWebEngineView):
 
 
     def requestImage(self, callback, width=None, height=None):
+        self.requestImages(lambda images: callback(images[0]),
+                           [{'format': 'png', 'width': width, 'height': height}])
+
+
+    def requestImages(self, callback, requests):
+        """
+        Render the chart once for each request, a dict with the format and the
+        width and height or None to use the chart size. The callback is passed
+        the list of image data.
+        """
+        requests = [dict(r, width=r.get('width') or 0, height=r.get('height') or 0)
+                    for r in requests]
         self.imageRequestCallbackQueue.put(callback)
-        self.handler.requestImage(width, height)
+        self.handler.requestImages(requests)
+
+
+    def requestTiledImage(self, callback, path, width, height, scale=1):
+        """
+        Write a PNG image of the chart, scaled by scale, rendered in tiles so
+        it can be larger than the chart can render at once. The callback is
+        passed whether the image was written.
+        """
+        self.cancelTiledImage()
+        self.tiledExport = TiledImageExport(
+            self.handler, callback, path, width, height, scale)
+        self.tiledExport.start()
+
+
+    def cancelTiledImage(self):
+        if self.tiledExport:
+            self.tiledExport.cancel()
+            self.tiledExport = None
 
 
-    def imageReady(self, imageUrl):
-        resp = urllib.request.urlopen(imageUrl)
-        data = resp.file.read()
-        self.imageRequestCallbackQueue.get()(data)
+    def imagesReady(self, imageUrls):
+        images = [urllib.request.urlopen(url).read() for url in imageUrls]
+        self.imageRequestCallbackQueue.get()(images)
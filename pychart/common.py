@@ -2,6 +2,8 @@
 import contextlib
 import os
 import sys
+import threading
+import time
 
 
 @contextlib.contextmanager
@@ -32,6 +34,30 @@ def writeFile(path, data):
         f.write(data)
 
 
+def writeFileInBackground(path, data):
+    """Write a file from a thread, so large files don't block the GUI"""
+    def write():
+        try:
+            writeFile(path, data)
+        except OSError as e:
+            print(f'Error: {e}')
+
+    # not a daemon, so the file is completed if the app quits
+    thread = threading.Thread(target=write)
+    thread.start()
+    return thread
+
+
+def formatBytes(nbytes):
+    """Format a byte count for display, e.g. '1.5 MB'"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if nbytes < 1024 or unit == 'GB':
+            break
+        nbytes /= 1024
+
+    return f'{nbytes:.0f} {unit}' if unit == 'B' else f'{nbytes:.1f} {unit}'
+
+
 def debugMethod(fn):
     def wrapped(*args, **kwargs):
         print(fn.__name__ + ' ⤵')
@@ -48,3 +74,24 @@ def debugClassMethod(fn):
         print(self.__class__.__name__ + '::' + fn.__name__ + ' ⤴')
 
     return wrapped
+
+
+class StartupProfiler:
+    """
+    Report elapsed time at named startup milestones on stderr.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.start = self.last = time.perf_counter()
+
+    def mark(self, label):
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        delta = (now - self.last) * 1000
+        total = (now - self.start) * 1000
+        self.last = now
+
+        print(f'startup: {label:<24} +{delta:8.1f} ms {total:9.1f} ms',
+              file=sys.stderr)
@@ -0,0 +1,217 @@
+"""
+Data files bound to script variables by a document.
+
+A binding names a variable, the path and format of a file, and optionally
+the columns of the file to use. The evaluation process opens the file with
+memory mapping where the format allows (NumPy .npy and Arrow IPC/Feather
+files), so the script gets arrays backed by the file instead of copies, and
+keeps recently used files open across evaluations until they change.
+Columns are read when the script first uses them.
+
+This module is loaded by evaluation processes, so it must not import Qt.
+"""
+import collections
+import collections.abc
+import csv
+import os
+
+from .sources import toColumn
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# data file formats by file extension
+FORMATS = {
+    '.npy': 'npy',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.csv': 'csv',
+}
+
+# number of opened files kept by a process
+FILE_CACHE_SIZE = 16
+
+# opened files by (path, format, columns), with the file stamp they were
+# opened at, least recently used first
+_files = collections.OrderedDict()
+
+
+def fileStamp(path):
+    """
+    Modification time and size of a file, which change when it is written.
+    """
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def getFormat(path):
+    """
+    Data file format of a path from its extension, or None.
+    """
+    (root, ext) = os.path.splitext(path)
+    return FORMATS.get(ext.lower())
+
+
+def bindingName(path):
+    """
+    Variable name for a data file, from its file name.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    name = ''.join(c if c.isalnum() else '_' for c in name)
+    return name if name.isidentifier() else '_' + name
+
+
+
+class Table(collections.abc.Mapping):
+    """
+    Read only mapping of column names to arrays, which reads a column when it
+    is first used.
+    """
+    def __init__(self, names, read):
+        self.names = list(names)
+        self.read = read
+        self.columns = {}
+
+    def __getitem__(self, name):
+        if name not in self.columns:
+            if name not in self.names:
+                raise KeyError(name)
+            self.columns[name] = self.read(name)
+
+        return self.columns[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return f'Table({self.names})'
+
+
+
+def selectColumns(path, names, columns):
+    """
+    Names of the columns to use from a file, which are all of its columns if
+    columns is not given.
+    """
+    if not columns:
+        return names
+
+    missing = [name for name in columns if name not in names]
+    if missing:
+        raise KeyError(f'{path} has no column {", ".join(map(repr, missing))}')
+
+    return columns
+
+
+def openNpy(path, columns):
+    """
+    Memory map a .npy file. Arrays with named fields are opened as a table of
+    their fields, other arrays are returned as is.
+    """
+    if numpy is None:
+        raise ImportError(f'NumPy is needed to read {path}')
+
+    data = numpy.load(path, mmap_mode='r', allow_pickle=False)
+    if data.dtype.names is None:
+        return data
+
+    names = selectColumns(path, data.dtype.names, columns)
+    return Table(names, lambda name: data[name])
+
+
+def openArrow(path, columns):
+    """
+    Memory map an Arrow IPC or Feather file as a table.
+    """
+    try:
+        from pyarrow import feather
+    except ImportError:
+        raise ImportError(f'pyarrow is needed to read {path}')
+
+    table = feather.read_table(path, columns=columns or None, memory_map=True)
+    names = selectColumns(path, table.column_names, columns)
+    return Table(names, lambda name: table.column(name).to_numpy())
+
+
+def parseValue(text):
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+
+    return text
+
+
+def openCsv(path, columns):
+    """
+    Open a CSV file with a header row as a table. CSV files can't be mapped,
+    so each column is parsed from the file when it is first used.
+    """
+    with open(path, newline='') as f:
+        header = next(csv.reader(f), [])
+
+    def read(name):
+        index = header.index(name)
+        with open(path, newline='') as f:
+            rows = csv.reader(f)
+            next(rows, None)
+            column = toColumn([parseValue(row[index]) if index < len(row) else None
+                               for row in rows])
+
+        # cached columns are shared by evaluations, so keep them unchanged
+        if numpy and isinstance(column, numpy.ndarray):
+            column.flags.writeable = False
+
+        return column
+
+    names = selectColumns(path, header, columns)
+    return Table(names, read)
+
+
+OPENERS = {
+    'npy': openNpy,
+    'arrow': openArrow,
+    'csv': openCsv,
+}
+
+
+def openBinding(binding):
+    """
+    Open the file of a binding, or reuse it if it is unchanged since it was
+    last opened.
+    """
+    path = binding['path']
+    fileFormat = binding.get('format') or getFormat(path)
+    if fileFormat not in OPENERS:
+        raise ValueError(f'Unknown data file format {fileFormat!r} of {path}')
+
+    columns = tuple(binding.get('columns') or ())
+    stamp = fileStamp(path)
+
+    key = (path, fileFormat, columns)
+    if key in _files and _files[key][0] == stamp:
+        _files.move_to_end(key)
+        return _files[key][1]
+
+    data = OPENERS[fileFormat](path, list(columns))
+    _files[key] = (stamp, data)
+    _files.move_to_end(key)
+
+    # files are unmapped and closed once nothing uses them
+    while len(_files) > FILE_CACHE_SIZE:
+        _files.popitem(last=False)
+
+    return data
+
+
+def openBindings(bindings):
+    """
+    Open the files of bindings as a dict of variables.
+    """
+    return {binding['name']: openBinding(binding) for binding in bindings}
@@ -1,57 +1,64 @@
-
-import sys
+import importlib
+import itertools
+import os
+import pickle
+import signal
+import threading
+import time
 import multiprocessing as mp
-import multiprocessing.queues as mpq
-
-from IPython.core.interactiveshell import InteractiveShell
-from IPython.utils import io
+from multiprocessing.connection import wait
 
 from PyQt5.QtCore import QObject, QThread, pyqtSignal
 
+from .worker import getDefaultEvaluator, process
 
+# modules imported once by the fork server before any worker is forked
+PRELOAD_MODULES = ['pychart.worker', 'IPython.core.interactiveshell']
 
-class StdoutQueue(mpq.Queue):
-    """
-    Multiprocessing Queue to be used in place of a simple file descriptor.
-    https://stackoverflow.com/a/39508408
-    """
-    def __init__(self, *args, **kwargs):
-        ctx = mp.get_context()
-        super().__init__(*args, **kwargs, ctx=ctx)
+# seconds a stopped script has to end before it is stopped more forcefully
+INTERRUPT_GRACE = 1.0
 
-    def write(self, msg):
-        self.put(msg)
+# seconds a closed process has to close its connections and exit
+CLOSE_GRACE = 1.0
 
-    def flush(self):
-        sys.__stdout__.flush()
+_context = None
+_poolSize = None
 
 
-class QueueMonitor(QThread):
-    def __init__(self, queue, signal):
-        super().__init__()
-        self.queue = queue
-        self.signal = signal
-        self.start()
+def setStartMethod(method, preload=()):
+    """
+    Select how evaluation processes are started. With 'forkserver', workers
+    are forked from a small Qt-free server process which imports the default
+    and given preload modules once.
+    """
+    global _context
+    _context = mp.get_context(method)
 
-    def __del__(self):
-        self.terminate()
-        self.wait()
+    if method == 'forkserver':
+        _context.set_forkserver_preload(PRELOAD_MODULES + list(preload))
+
+        # start the server now so preloading overlaps application startup
+        from multiprocessing import forkserver
+        forkserver.ensure_running()
 
-    def run(self):
-        while True:
-            self.signal.emit(self.queue.get())
 
+def getContext():
+    """
+    Multiprocessing context used to start evaluation processes.
+    """
+    return _context or mp.get_context()
 
 
-def process(conn, stdout):
-    shell = InteractiveShell()
+def setPoolSize(size):
+    """
+    Set the number of evaluations run at once, the default is the CPU count.
+    """
+    global _poolSize
+    _poolSize = size
 
-    orig, sys.stdout = sys.stdout, stdout
-    execRes = shell.run_cell(conn.recv())
-    sys.stdout = orig
 
-    res = (execRes.result, execRes.error_before_exec or execRes.error_in_exec)
-    conn.send(res)
+def getPoolSize():
+    return _poolSize or os.cpu_count() or 1
 
 
 
@@ -59,107 +66,511 @@ class Signals(QObject):
     started = pyqtSignal()
     finished = pyqtSignal()
     result = pyqtSignal(object)
+    partial = pyqtSignal(object, object)
     error = pyqtSignal()
     stdout = pyqtSignal(str)
+    interrupted = pyqtSignal(str)
+    ended = pyqtSignal(object)
 
 
-class ProcessManager(QThread):
-    def __init__(self):
-        super().__init__()
-
+class Channel:
+    """
+    Evaluation state of one session within the hub.
+    """
+    def __init__(self, sid):
+        self.id = sid
         self.signals = Signals()
 
+        # shared with the GUI thread, guarded by the hub lock
         self.busy = False
-        self.proc = None
-        self.pipe = mp.Pipe()
+        self.pending = None
+        self.submitted = 0
+        self.cancel = False
+        self.closed = False
 
-        self.stout = StdoutQueue()
-        self.stoutMonitor = QueueMonitor(self.stout, self.signals.stdout)
+        # owned by the hub thread
+        self.worker = None
+        self.lastWorker = None
 
-    # def __del__(self):
-    #     if self.isRunning():
-    #         self.stop()
 
-    def run(self):
-        while True:
-            # manager and process ends of a pipe
-            (mgrConn, procConn) = self.pipe
-            args = (procConn, self.stout)
-            p = self.proc = mp.Process(target=process, args=args, daemon=True)
-            p.start()
-            p.join()
-            p.close()
-
-            self.busy = False
-            # if process was not interrupted, we have a (result, exception)
-            if mgrConn.poll():
-                badType = False
-                try:
-                    res, exc = mgrConn.recv()
-                    badType = type(res) != dict
-                except AttributeError:
-                    badType = True
-
-                if not exc and badType:
-                    err = "\nError: Return type must be a dict " \
-                          "containing only primitives and collections."
-                    self.signals.stdout.emit(err)
-                    self.signals.error.emit()
-                    continue
 
-                if exc:
-                    self.signals.error.emit()
-                else:
-                    self.signals.result.emit(res)
+class Worker:
+    """
+    Evaluation process within the hub's pool.
+    """
+    def __init__(self, ctx):
+        (self.conn, procConn) = mp.Pipe()
+        args = (procConn, getDefaultEvaluator())
+        self.proc = ctx.Process(target=process, args=args, daemon=True)
+        self.proc.start()
+        procConn.close()
+
+        # channel whose job is running, None while idle, and the job's tag
+        self.channel = None
+        self.tag = None
+
+        # escalation of a stop request and when the next stage is due
+        self.stage = None
+        self.deadline = None
+
+    def interrupt(self, grace):
+        """
+        Ask the running script to stop by raising KeyboardInterrupt in it.
+        """
+        os.kill(self.proc.pid, signal.SIGINT)
+        self.stage = 'interrupt'
+        self.deadline = time.monotonic() + grace
+
+    def escalate(self, grace):
+        """
+        Move on to the next, more forceful, way of stopping the process.
+        """
+        if self.stage == 'interrupt':
+            self.proc.terminate()
+            self.stage = 'terminate'
+            self.deadline = time.monotonic() + grace
+
+        elif self.stage == 'terminate':
+            self.proc.kill()
+            self.stage = 'kill'
+            self.deadline = None
+
+    def release(self):
+        """
+        Ask the process to close its pooled connections and exit, once any
+        running job has ended. Processes started by forking may hold the
+        other end of the pipe, so they are told rather than seeing it closed.
+        """
+        if self.conn.closed:
+            return
+
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass  # already exited
+
+        self.conn.close()
+
+    def close(self):
+        self.release()
+        self.proc.join(CLOSE_GRACE)
+        if self.proc.is_alive():
+            self.proc.terminate()
+            self.proc.join()
+
+        self.proc.close()
+
+
+
+class EvaluationHub(QThread):
+    """
+    Single thread servicing a bounded pool of evaluation processes shared by
+    every session.
+
+    The thread sleeps in one wait on all process pipes and sentinels plus a
+    wakeup pipe, so the number of threads and idle wakeups does not grow with
+    the number of open documents. Sessions register to receive a channel id
+    and subscribe to the signals of that channel. Requests from the GUI thread
+    only set channel state under a lock and write to the wakeup pipe.
+
+    At most one job per channel waits to run, so a newer job replaces one not
+    yet started. Waiting jobs run as processes become free, the focused
+    channel first and then in the order they were submitted, preferably on
+    the process which ran the channel's previous job.
+
+    Processes evaluate one job after another. Stopping a job first raises
+    KeyboardInterrupt in the script, which leaves the process usable, and only
+    sends SIGTERM and then SIGKILL if the script has not ended within the
+    grace period. The stage which ended the job is reported by the channel's
+    interrupted signal.
+
+    A job's optional 'tag' is passed with the sources it publishes and by the
+    ended signal following its result, so a channel's subscriber can tell
+    the signals of a stopped job from those of the job replacing it.
+
+    A spare process outside of the pool is kept started and initialized. It
+    joins the pool as soon as a pool process exits, or when the pool needs a
+    new process, and is then replaced in the background.
+    """
+    _instance = None
 
-            self.signals.finished.emit()
+    @classmethod
+    def instance(cls):
+        """
+        Shared hub of the application.
+        """
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
 
+    def __init__(self):
+        super().__init__()
 
-            if self.isInterruptionRequested():
-                break
+        self.ctx = getContext()
+        self.size = getPoolSize()
+        self.grace = INTERRUPT_GRACE
+        self.lock = threading.Lock()
+        (self.wakeReader, self.wakeWriter) = mp.Pipe(duplex=False)
+
+        self.ids = itertools.count(1)
+        self.submissions = itertools.count(1)
+        self.channels = {}
+        self.focus = set()
+
+        # owned by the hub thread
+        self.workers = []
+        self.spare = None
+
+    def register(self):
+        """
+        Add a channel for a session and return its id. The hub thread runs
+        while any channel is registered.
+        """
+        sid = next(self.ids)
+        with self.lock:
+            self.channels[sid] = Channel(sid)
+
+        if not self.isRunning():
+            self.start()
+
+        return sid
+
+    def unregister(self, sid):
+        """
+        Remove a channel and terminate its process. Removing the last channel
+        ends the hub thread.
+        """
+        with self.lock:
+            channel = self.channels[sid]
+            channel.closed = True
+            channel.pending = None
+            channel.cancel = True
+            remaining = [c for c in self.channels.values() if not c.closed]
+
+        if remaining:
+            self.wake()
+        else:
+            self.requestInterruption()
+            self.wake()
+            self.wait()
+
+    def signals(self, sid):
+        return self.channels[sid].signals
+
+    def setFocus(self, *sids):
+        """
+        Give the channels' jobs priority over those of other channels.
+        """
+        with self.lock:
+            self.focus = set(sids)
+
+        self.wake()
+
+    def isFocused(self, sid):
+        with self.lock:
+            return sid in self.focus
+
+    def setSize(self, size):
+        """
+        Set the number of processes in the pool. Processes above a smaller
+        size are closed once they are idle.
+        """
+        with self.lock:
+            self.size = size
+
+        self.wake()
 
-    def stop(self):
-        """Terminate the process and interrupt the thread."""
-        self.requestInterruption()
-        self.stopEvaluation()
-        self.wait()
+    def run(self):
+        # import IPython here rather than in the GUI thread at startup, forked
+        # processes then inherit the loaded module instead of importing it
+        if self.ctx.get_start_method() == 'fork':
+            importlib.import_module('IPython.core.interactiveshell')
 
-    def isEvaluating(self):
-        return self.busy
+        self.replenish()
 
-    def startEvaluation(self, raw):
-        """Evaluate raw code with process"""
-        assert(not self.isEvaluating())
-        self.busy = True
-        (mgrConn, procConn) = self.pipe
+        while not self.isInterruptionRequested():
+            with self.lock:
+                channels = list(self.channels.values())
 
-        # clear any waiting code
-        while procConn.poll():
-            procConn.recv()
+            for channel in channels:
+                self.service(channel)
 
-        mgrConn.send(raw)
-        self.signals.started.emit()
+            self.schedule(channels)
+            self.shrink()
 
-    def stopEvaluation(self):
-        # terminate the current process
-        self.proc.terminate()
+            waitables = {self.wakeReader: None}
+            for worker in self.workers:
+                waitables[worker.conn] = worker
+                waitables[worker.proc.sentinel] = worker
 
-        # wait until process is no longer running
-        while self.busy:
-            pass
+            if self.spare:
+                waitables[self.spare.proc.sentinel] = self.spare
 
-        # may need to resort to .kill()
+            ready = wait(list(waitables), self.timeout())
 
+            if self.wakeReader in ready:
+                while self.wakeReader.poll():
+                    self.wakeReader.recv_bytes()
 
+            for worker in {waitables[obj] for obj in ready} - {None}:
+                if worker is self.spare:
+                    # not replaced here, so a failing start can't spin
+                    self.spare.close()
+                    self.spare = None
+                    continue
 
-if __name__ == '__main__':
-    app = QCoreApplication(sys.argv)
+                self.receive(worker)
+
+                if worker.proc.sentinel in ready:
+                    self.workers.remove(worker)
+                    exitcode = worker.proc.exitcode
+                    worker.close()
+
+                    if worker.channel:
+                        # a process which wasn't stopped has crashed
+                        if not worker.stage and not worker.channel.closed:
+                            signals = worker.channel.signals
+                            signals.stdout.emit(f'\nError: Evaluation process exited with code {exitcode}')
+                            signals.error.emit()
+
+                        self.endJob(worker)
+
+                    if len(self.workers) < self.size:
+                        self.promote()
+
+            # escalate stop requests which were not honoured in time
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.deadline and worker.deadline <= now:
+                    worker.escalate(self.grace)
+
+        # processes exit at the same time, rather than one grace period after
+        # another
+        closing = self.workers + ([self.spare] if self.spare else [])
+        for worker in closing:
+            worker.release()
+
+        for worker in closing:
+            worker.close()
+
+        (self.workers, self.spare) = ([], None)
+        with self.lock:
+            self.channels.clear()
+
+    def service(self, channel):
+        """
+        Apply stop requests made to a channel since the last pass.
+        """
+        with self.lock:
+            (cancel, channel.cancel) = (channel.cancel, False)
+            pending = channel.pending is not None
+
+            if channel.closed and not channel.worker:
+                del self.channels[channel.id]
+
+        if not cancel:
+            return
+
+        if channel.worker and not channel.worker.stage:
+            channel.worker.interrupt(self.grace)
+
+        elif not pending and not channel.closed:
+            # nothing was running, so the stop takes effect immediately
+            self.finishEvaluation(channel)
+
+    def schedule(self, channels):
+        """
+        Send waiting jobs to free processes, keeping a process started ahead
+        of time while the pool has room.
+        """
+        with self.lock:
+            waiting = [c for c in channels if c.pending and not c.worker]
+            waiting.sort(key=lambda c: (c.id not in self.focus, c.submitted))
+
+        for channel in waiting:
+            worker = self.idleWorker(channel)
+            if not worker:
+                break
 
-    ph = ProcessHandler()
-    ph.completed.connect(print)
+            with self.lock:
+                (job, channel.pending) = (channel.pending, None)
+
+            if job is None:
+                continue
+
+            worker.conn.send(job)
+            worker.channel = channel
+            worker.tag = job.get('tag')
+            channel.worker = worker
+            channel.lastWorker = worker
+
+    def idleWorker(self, channel):
+        """
+        Return an idle process, adding one to the pool if it has room. The
+        process which ran the channel's last job is preferred, as it has
+        already run the setup of the channel's document.
+        """
+        idle = [worker for worker in self.workers if not worker.channel]
+        if channel.lastWorker in idle:
+            return channel.lastWorker
+
+        if idle:
+            return idle[0]
+
+        if len(self.workers) < self.size:
+            return self.promote()
+
+        return None
+
+    def shrink(self):
+        """
+        Close idle processes while the pool has more than its size, busy
+        processes are closed once their jobs have ended.
+        """
+        idle = [worker for worker in self.workers if not worker.channel]
+        for worker in idle[:max(0, len(self.workers) - self.size)]:
+            self.workers.remove(worker)
+            worker.close()
+
+    def promote(self):
+        """
+        Move the spare process into the pool and start a new spare. Returns
+        the process added to the pool.
+        """
+        (worker, self.spare) = (self.spare or Worker(self.ctx), None)
+        self.workers.append(worker)
+        self.replenish()
+        return worker
+
+    def replenish(self):
+        """
+        Start a spare process if there is none.
+        """
+        if not self.spare:
+            self.spare = Worker(self.ctx)
+
+    def timeout(self):
+        """
+        Seconds until the next stop request escalation is due, or None.
+        """
+        deadlines = [w.deadline for w in self.workers if w.deadline]
+        if not deadlines:
+            return None
+
+        return max(0, min(deadlines) - time.monotonic())
+
+    def receive(self, worker):
+        """
+        Handle all messages waiting in a process pipe.
+        """
+        try:
+            while worker.conn.poll():
+                (kind, data) = worker.conn.recv()
+                channel = worker.channel
+
+                # messages of idle processes are read so their pipes don't
+                # stay readable, but have no channel to go to
+                if channel is None:
+                    continue
 
-    ph.start()
-    ph.evaluate('1+1')
-    ph.evaluate("print('hello world')")
+                if kind == 'stdout' and not channel.closed:
+                    channel.signals.stdout.emit(data)
+
+                elif kind == 'partial' and not channel.closed and not worker.stage:
+                    sources = self.unpickle(channel, data)
+                    if sources is not None:
+                        channel.signals.partial.emit(worker.tag, sources)
+
+                elif kind == 'result':
+                    # a result which can't be unpickled is reported as an error
+                    (res, exc) = self.unpickle(channel, data) or (None, True)
+                    if not channel.closed:
+                        self.handleResult(channel.signals, res, exc)
+                    self.endJob(worker)
+
+        except (EOFError, OSError):
+            pass
 
-    sys.exit(app.exec_())
+    def unpickle(self, channel, data):
+        """
+        Unpickle the data of a message, or return None if it can't be, e.g.
+        when it contains instances of classes defined by the script.
+        """
+        try:
+            return pickle.loads(data)
+        except Exception as e:
+            if not channel.closed:
+                channel.signals.stdout.emit(f"\nError: Data sent by the script can't be read: {e!r}")
+            return None
+
+    def endJob(self, worker):
+        """
+        Release a worker from its channel once its job has ended.
+        """
+        (channel, worker.channel) = (worker.channel, None)
+        (stage, worker.stage, worker.deadline) = (worker.stage, None, None)
+        (tag, worker.tag) = (worker.tag, None)
+        channel.worker = None
+
+        if channel.closed:
+            return
+
+        if stage:
+            channel.signals.interrupted.emit(stage)
+
+        channel.signals.ended.emit(tag)
+
+        self.finishEvaluation(channel)
+
+    def handleResult(self, signals, res, exc):
+        if not exc and type(res) != dict:
+            err = "\nError: Return type must be a dict " \
+                  "containing only primitives and collections."
+            signals.stdout.emit(err)
+            signals.error.emit()
+
+        elif exc:
+            signals.error.emit()
+
+        else:
+            signals.result.emit(res)
+
+    def finishEvaluation(self, channel):
+        with self.lock:
+            channel.busy = channel.pending is not None
+
+        channel.signals.finished.emit()
+
+    def wake(self):
+        self.wakeWriter.send_bytes(b'\0')
+
+    def isEvaluating(self, sid):
+        # signals queued before a channel was removed may still ask about it
+        channel = self.channels.get(sid)
+        return channel is not None and channel.busy
+
+    def startEvaluation(self, sid, job):
+        """
+        Queue a script job, which starts once any running job of the channel
+        has ended and a process is free.
+        """
+        channel = self.channels[sid]
+        with self.lock:
+            channel.busy = True
+            channel.pending = job
+            channel.submitted = next(self.submissions)
+
+        self.wake()
+        channel.signals.started.emit()
+
+    def stopEvaluation(self, sid):
+        """
+        Terminate the running job and drop any job waiting to start. Returns
+        without waiting, the finished signal is emitted once it has stopped.
+        """
+        channel = self.channels[sid]
+        with self.lock:
+            channel.pending = None
+            channel.cancel = True
+
+        self.wake()
@@ -0,0 +1,63 @@
+"""
+JSON encoding for the chart web channel and document files.
+
+orjson is used when it is installed, which encodes NumPy arrays, datetimes
+and numeric scalars natively. Otherwise the standard library json module is
+used with a default hook converting the same types.
+"""
+import array
+import datetime
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    """
+    Convert values the encoder does not support to JSON types.
+    """
+    if isinstance(obj, array.array):
+        return obj.tolist()
+
+    # numpy arrays and scalars
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+
+    # other iterables, e.g. range and generators
+    try:
+        return list(obj)
+    except TypeError:
+        raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def dumps(obj, indent=False):
+    """
+    Encode an object to a JSON string, indented if indent is set.
+    """
+    if orjson:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+
+        try:
+            return orjson.dumps(obj, default=default, option=option).decode()
+        except TypeError:
+            pass  # e.g. integers larger than 64 bits, which json supports
+
+    return json.dumps(obj, default=default, indent=2 if indent else None)
+
+
+def loads(text):
+    """
+    Decode a JSON string or bytes.
+    """
+    if orjson:
+        return orjson.loads(text)
+
+    return json.loads(text)
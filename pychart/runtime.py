@@ -0,0 +1,231 @@
+"""
+Functions for scripts to call while they are evaluated, e.g.
+
+    import pychart
+    db = pychart.connection('sales')
+    pychart.publish({'x': x[:1000]})
+
+Data sources published by a long running script are shown by the chart
+before the script ends, until the script's result replaces them. They are
+sent at most once per PUBLISH_INTERVAL seconds, later sources are merged
+into those waiting to be sent, which a timer sends once the interval has
+passed. Sources may be sent after publish returns, so scripts should not
+modify them afterwards.
+
+Database connections are configured per document by name, with the name of
+a DB-API module and the arguments of its connect function:
+
+    "connections": {"sales": {"module": "sqlite3", "args": ["sales.db"]}}
+
+Evaluation processes run many jobs, so connections are kept open between
+evaluations in a pool per configuration. A connection is checked with a
+query before it is reused and replaced if the check fails, and pools are
+closed when the process exits.
+
+This module is loaded by evaluation processes, so it must not import Qt.
+"""
+import importlib
+import json
+import threading
+import time
+
+# query run on a pooled connection before it is reused
+CHECK_QUERY = 'SELECT 1'
+
+# seconds between data sources published to the chart
+PUBLISH_INTERVAL = 0.25
+
+# function sending published data sources of the running job, sources
+# waiting to be sent, and the timer sending them
+_publisher = None
+_published = {}
+_publishTime = 0
+_publishTimer = None
+_publishLock = threading.Lock()
+
+# connection configurations of the running job by name
+_configs = {}
+
+# pools by configuration, and connections taken from them by the running job
+_pools = {}
+_taken = {}
+
+
+
+class ConnectionPool:
+    """
+    Idle connections of one configuration.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.idle = []
+
+    def connect(self):
+        module = importlib.import_module(self.config['module'])
+        return module.connect(*self.config.get('args', ()), **self.config.get('kwargs', {}))
+
+    def check(self, conn):
+        """
+        Whether a connection still works.
+        """
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.config.get('check', CHECK_QUERY))
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        while self.idle:
+            conn = self.idle.pop()
+            if self.check(conn):
+                return conn
+            closeQuietly(conn)
+
+        return self.connect()
+
+    def release(self, conn):
+        """
+        Return a connection to the pool, rolling back anything the script
+        did not commit.
+        """
+        try:
+            conn.rollback()
+        except Exception:
+            closeQuietly(conn)
+            return
+
+        if len(self.idle) < self.config.get('size', 1):
+            self.idle.append(conn)
+        else:
+            closeQuietly(conn)
+
+    def close(self):
+        for conn in self.idle:
+            closeQuietly(conn)
+        self.idle = []
+
+
+
+def closeQuietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def connection(name):
+    """
+    Connection of the document's connection configuration name, taken from
+    the pool for the rest of the evaluation. Calls with the same name return
+    the same connection.
+    """
+    if name in _taken:
+        return _taken[name][1]
+
+    if name not in _configs:
+        raise KeyError(f'No connection named {name!r} in the document, '
+                       f'available connections: {", ".join(_configs) or "none"}')
+
+    config = _configs[name]
+    key = json.dumps(config, sort_keys=True)
+    pool = _pools.setdefault(key, ConnectionPool(config))
+
+    conn = pool.acquire()
+    _taken[name] = (pool, conn)
+    return conn
+
+
+def publish(sources):
+    """
+    Show data sources in the chart while the script is still running, e.g.
+    the results so far of a long computation. The script's result replaces
+    them once it ends.
+    """
+    global _publishTimer
+    if not isinstance(sources, dict):
+        raise TypeError('Published data sources must be a dict')
+
+    with _publishLock:
+        if _publisher is None:
+            return
+
+        _published.update(sources)
+        delay = _publishTime + PUBLISH_INTERVAL - time.monotonic()
+        if delay <= 0:
+            sendPublished()
+        elif _publishTimer is None:
+            _publishTimer = threading.Timer(delay, sendPublishedLater)
+            _publishTimer.daemon = True
+            _publishTimer.start()
+
+
+def sendPublished():
+    """
+    Send the sources waiting to be sent, with the publish lock held.
+    """
+    global _publishTime
+    if _published and _publisher:
+        _publisher(dict(_published))
+
+    _published.clear()
+    _publishTime = time.monotonic()
+
+
+def sendPublishedLater():
+    global _publishTimer
+    with _publishLock:
+        _publishTimer = None
+        try:
+            sendPublished()
+        except Exception:
+            # the script may have changed the sources while they were sent
+            _published.clear()
+
+
+def beginJob(configs, publisher=None):
+    """
+    Make the connection configurations of a job available to its script,
+    and set the function sending a dict of the sources it publishes, if
+    they are shown.
+    """
+    global _configs, _publisher
+    _configs = dict(configs or {})
+
+    with _publishLock:
+        _publisher = publisher
+
+
+def endJob():
+    """
+    Return the connections taken by a job to their pools, and drop its
+    published sources which were not sent. Sources published afterwards,
+    e.g. by threads the script left running, are ignored.
+    """
+    global _configs, _publisher, _publishTime, _publishTimer
+    for (pool, conn) in _taken.values():
+        pool.release(conn)
+
+    _taken.clear()
+    _configs = {}
+
+    # sources not yet sent are replaced by the result
+    with _publishLock:
+        if _publishTimer:
+            _publishTimer.cancel()
+
+        _published.clear()
+        (_publisher, _publishTime, _publishTimer) = (None, 0, None)
+
+
+def closeConnections():
+    """
+    Close every pooled connection, when the evaluation process exits.
+    """
+    endJob()
+    for pool in _pools.values():
+        pool.close()
+
+    _pools.clear()
@@ -1,18 +1,14 @@
 
-import asyncio
+import functools
 import re
-import traceback
-
-import multiprocessing as mp
-import time
 
 from PyQt5.QtWidgets import QWidget, QPushButton, QHBoxLayout, QVBoxLayout, \
-                            QTextEdit, QStyle, QLabel
-from PyQt5.QtCore import Qt, QObject, QSize, pyqtSignal
-from PyQt5.QtGui import QFont, QFontMetrics, QColor
-from PyQt5.Qsci import QsciScintilla, QsciLexerPython
+                            QTextEdit, QStyle, QLabel, QTabWidget, QTabBar, QMessageBox
+from PyQt5.QtCore import QObject, QSize, pyqtSignal
+from PyQt5.QtGui import QFont
 
-from .common import disconnectSignal
+from .common import disconnectSignal, formatBytes
+from .worker import findSyntaxError
 
 
 class ScriptConsole(QTextEdit):
@@ -41,102 +37,6 @@ class ScriptConsole(QTextEdit):
 
 
 
-class PythonTextField(QsciScintilla):
-    ARROW_MARKER_NUM = 8
-    DEFAULT_SIZE = 400
-
-    shiftReturnPressed = pyqtSignal()
-    shiftBackspacePressed = pyqtSignal()
-
-    def __init__(self, parent=None):
-        super().__init__(parent)
-
-        # Set the default font
-        font = QFont()
-        font.setFamily('Courier')
-        font.setFixedPitch(True)
-        font.setPointSize(12)
-        self.setFont(font)
-        self.setMarginsFont(font)
-
-
-
-        # Margin 0 is used for line numbers
-        fontmetrics = QFontMetrics(font)
-        self.setMarginsFont(font)
-        self.setMarginWidth(0, fontmetrics.width("0000"))
-        self.setMarginLineNumbers(0, True)
-        self.setMarginsBackgroundColor(QColor("#cccccc"))
-
-        self.setTabWidth(4)
-
-
-        # # Clickable margin 1 for showing markers
-        # self.setMarginSensitivity(1, True)
-        # self.marginClicked.connect(self.on_margin_clicked)
-        # self.markerDefine(QsciScintilla.RightArrow,
-        #     self.ARROW_MARKER_NUM)
-        # self.setMarkerBackgroundColor(QColor("#ee1111"),
-        #     self.ARROW_MARKER_NUM)
-
-        # Brace matching: enable for a brace immediately before or after
-        # the current position
-        #
-        self.setBraceMatching(QsciScintilla.SloppyBraceMatch)
-
-        # Current line visible with special background color
-        self.setCaretLineVisible(True)
-        self.setCaretLineBackgroundColor(QColor("#ffe4e4"))
-
-        # Set Python lexer
-        # Set style for Python comments (style number 1) to a fixed-width
-        # courier.
-        #
-
-        lexer = QsciLexerPython()
-        lexer.setDefaultFont(font)
-        self.setLexer(lexer)
-        text = bytearray(str.encode("Courier"))
-        self.SendScintilla(QsciScintilla.SCI_STYLESETFONT, 1, text)
-        self.SendScintilla(QsciScintilla.SCI_STYLESETSIZE, 1, 12)
-
-
-        # Don't want to see the horizontal scrollbar at all
-        # Use raw message to Scintilla here (all messages are documented
-        # here: http://www.scintilla.org/ScintillaDoc.html)
-        self.SendScintilla(QsciScintilla.SCI_SETHSCROLLBAR, 0)
-        self.setScrollWidth(1)
-
-        # not too small
-        # self.setMinimumSize(500, 450)
-    #
-    # def on_margin_clicked(self, nmargin, nline, modifiers):
-    #     # Toggle marker for the line the margin was clicked on
-    #     if self.markersAtLine(nline) != 0:
-    #         self.markerDelete(nline, self.ARROW_MARKER_NUM)
-    #     else:
-    #         self.markerAdd(nline, self.ARROW_MARKER_NUM)
-
-    def keyPressEvent(self, e):
-        # intercept special key combos
-        if (e.key() == Qt.Key_Return and e.modifiers() == Qt.ShiftModifier):
-            self.shiftReturnPressed.emit()
-
-        elif (e.key() == Qt.Key_Backspace and e.modifiers() == Qt.ShiftModifier):
-            self.shiftBackspacePressed.emit()
-
-        elif (e.key() == Qt.Key_Tab):
-            line,idx = self.getCursorPosition()
-            self.insertAt(4 * ' ', line, idx)
-            self.setCursorPosition(line, idx + 4)
-
-        else:
-            super().keyPressEvent(e)
-
-    def sizeHint(self):
-        return QSize(self.DEFAULT_SIZE, self.DEFAULT_SIZE)
-
-
 class ScriptEditorControlBar(QWidget):
 
     def __init__(self, parent = None):
@@ -163,6 +63,7 @@ class ScriptEditorControlBar(QWidget):
         # btn.setContentsMargins(0, 0, 0, 0)
 
         self.statusLabel = lbl = QLabel('')
+        self.sizeLabel = QLabel('')
 
         layout = QHBoxLayout()
         layout.setContentsMargins(10,0,10,0)
@@ -170,6 +71,7 @@ class ScriptEditorControlBar(QWidget):
         layout.addWidget(self.startButton)
         layout.addWidget(self.stopButton)
         layout.addStretch()     # fill space right of buttons
+        layout.addWidget(self.sizeLabel)
         layout.addWidget(self.statusLabel)
 
         self.setLayout(layout)
@@ -182,6 +84,13 @@ class ScriptEditorControlBar(QWidget):
     def setStatus(self, text):
         self.statusLabel.setText(text)
 
+    def setSourceSizes(self, sizes):
+        """Show the memory used by data sources, per source in the tooltip"""
+        total = sum(sizes.values())
+        self.sizeLabel.setText(formatBytes(total) if sizes else '')
+        self.sizeLabel.setToolTip('\n'.join(
+            f'{name}: {formatBytes(size)}' for name, size in sorted(sizes.items())))
+
 
 class ScriptEditorModel(QObject):
     VERSION = 1
@@ -190,9 +99,15 @@ class ScriptEditorModel(QObject):
     dataChanged = pyqtSignal()
     wasModified = pyqtSignal()
 
-    def __init__(self, script=None):
+    def __init__(self, script=None, evaluator=None, bindings=None, connections=None,
+                 setup=None, sections=None):
         super().__init__()
         self.script = script if script else self.DEFAULT_SCRIPT
+        self.setup = setup or ''
+        self.sections = sections or []
+        self.evaluator = evaluator
+        self.bindings = bindings or []
+        self.connections = connections or {}
 
     def getScript(self):
         return self.script
@@ -202,19 +117,89 @@ class ScriptEditorModel(QObject):
         self.wasModified.emit()
         self.dataChanged.emit()
 
+    def getSections(self):
+        """
+        Named scripts evaluated alongside the script, a list of dicts with the
+        name and script of each. Each section returns a dict of data sources,
+        which are merged with those of the script.
+        """
+        return self.sections
+
+    def setSections(self, sections):
+        self.sections = sections
+        self.wasModified.emit()
+        self.dataChanged.emit()
+
+    def getSetup(self):
+        """
+        Script run once by each evaluation process before the first evaluation
+        of the script, and again only when it changes. Variables it defines
+        are defined for every evaluation of the script.
+        """
+        return self.setup
+
+    def setSetup(self, setup):
+        self.setup = setup
+        self.wasModified.emit()
+        self.dataChanged.emit()
+
+    def getEvaluator(self):
+        """
+        Name of the evaluator for this script, or None to use the default.
+        """
+        return self.evaluator
+
+    def setEvaluator(self, evaluator):
+        if self.evaluator != evaluator:
+            self.evaluator = evaluator
+            self.wasModified.emit()
+
+    def getBindings(self):
+        """
+        Data files defined as variables of the script, a list of dicts with
+        the variable name, the file path, and optionally its format and the
+        columns to use.
+        """
+        return self.bindings
+
+    def setBindings(self, bindings):
+        self.bindings = bindings
+        self.wasModified.emit()
+        self.dataChanged.emit()
+
+    def getConnections(self):
+        """
+        Database connections the script can get with pychart.connection, a
+        dict of names to the DB-API module and connect arguments of each.
+        """
+        return self.connections
+
+    def setConnections(self, connections):
+        self.connections = connections
+        self.wasModified.emit()
+
     def serialize(self):
         return {
             '_version_': self.VERSION,
             'script': self.script,
+            'setup': self.setup,
+            'sections': self.sections,
+            'evaluator': self.evaluator,
+            'bindings': self.bindings,
+            'connections': self.connections,
         }
 
     @classmethod
     def unserialize(cls, data):
-        return cls(data['script'])
+        return cls(data['script'], data.get('evaluator'), data.get('bindings'),
+                   data.get('connections'), data.get('setup'), data.get('sections'))
 
 
 
 class ScriptEditor(QWidget):
+    # index of the first section tab
+    SECTIONS_INDEX = 2
+
     # dataChanged = pyqtSignal()
     startEvaluation = pyqtSignal()
     stopEvaluation = pyqtSignal()
@@ -222,6 +207,10 @@ class ScriptEditor(QWidget):
     def __init__(self):
         super().__init__()
 
+        # QScintilla is only needed once an editor is shown, so keep it out of
+        # the import path of headless commands such as 'run'
+        from .textfield import PythonTextField
+
         self.model = None
 
         self.controlBar = ScriptEditorControlBar()
@@ -233,12 +222,29 @@ class ScriptEditor(QWidget):
         self.pythonTextField.shiftBackspacePressed.connect(self.stopEvaluation)
         self.pythonTextField.textChanged.connect(self.scriptTextChanged)
 
+        # setup script evaluated once per evaluation process
+        self.setupTextField = PythonTextField()
+        self.setupTextField.shiftReturnPressed.connect(self.startEvaluation)
+        self.setupTextField.shiftBackspacePressed.connect(self.stopEvaluation)
+        self.setupTextField.textChanged.connect(self.setupTextChanged)
+
+        # named sections follow the script and setup tabs, only they close
+        self.sectionFields = {}
+        self.tabs = QTabWidget()
+        self.tabs.setDocumentMode(True)
+        self.tabs.setTabsClosable(True)
+        self.tabs.tabCloseRequested.connect(self.removeSection)
+        self.tabs.addTab(self.pythonTextField, 'Script')
+        self.tabs.addTab(self.setupTextField, 'Setup')
+        for index in range(self.SECTIONS_INDEX):
+            self.tabs.tabBar().setTabButton(index, QTabBar.RightSide, None)
+
         layout = QVBoxLayout()
         layout.setProperty('class', 'CodeEditorLayout')
         layout.setSpacing(2)
         layout.setContentsMargins(0,4,0,0)
         layout.addWidget(self.controlBar)
-        layout.addWidget(self.pythonTextField)
+        layout.addWidget(self.tabs)
         self.setLayout(layout)
 
     def getModel(self):
@@ -255,11 +261,91 @@ class ScriptEditor(QWidget):
         with disconnectSignal(self.pythonTextField.textChanged, self.scriptTextChanged):
             self.pythonTextField.setText(self.model.getScript())
 
+        with disconnectSignal(self.setupTextField.textChanged, self.setupTextChanged):
+            self.setupTextField.setText(self.model.getSetup())
+
+        sections = self.model.getSections()
+        if [section['name'] for section in sections] != list(self.sectionFields):
+            self.createSectionTabs(sections)
+
+        for section in sections:
+            (field, slot) = self.sectionFields[section['name']]
+            if field.text() != section['script']:
+                with disconnectSignal(field.textChanged, slot):
+                    field.setText(section['script'])
+
+    def createSectionTabs(self, sections):
+        """Replace the section tabs with tabs for the given sections"""
+        from .textfield import PythonTextField
+
+        while self.tabs.count() > self.SECTIONS_INDEX:
+            field = self.tabs.widget(self.SECTIONS_INDEX)
+            self.tabs.removeTab(self.SECTIONS_INDEX)
+            field.deleteLater()
+
+        self.sectionFields = {}
+        for section in sections:
+            field = PythonTextField()
+            field.shiftReturnPressed.connect(self.startEvaluation)
+            field.shiftBackspacePressed.connect(self.stopEvaluation)
+            slot = functools.partial(self.sectionTextChanged, section['name'])
+            field.textChanged.connect(slot)
+
+            self.sectionFields[section['name']] = (field, slot)
+            self.tabs.addTab(field, section['name'])
+
+    def showSection(self, name):
+        (field, slot) = self.sectionFields[name]
+        self.tabs.setCurrentWidget(field)
+
     def scriptTextChanged(self):
         # text changed in widget, so update model but ignore change signal
         with disconnectSignal(self.model.dataChanged, self.refresh):
             self.model.setScript(self.pythonTextField.text())
 
+    def setupTextChanged(self):
+        with disconnectSignal(self.model.dataChanged, self.refresh):
+            self.model.setSetup(self.setupTextField.text())
+
+    def sectionTextChanged(self, name):
+        (field, slot) = self.sectionFields[name]
+        sections = [dict(section, script=field.text()) if section['name'] == name else section
+                    for section in self.model.getSections()]
+
+        with disconnectSignal(self.model.dataChanged, self.refresh):
+            self.model.setSections(sections)
+
+    def removeSection(self, index):
+        name = self.tabs.tabText(index)
+        res = QMessageBox.question(self, 'Remove Section',
+                                   f'Remove the script section "{name}"?')
+        if res != QMessageBox.Yes:
+            return
+
+        self.model.setSections([section for section in self.model.getSections()
+                                if section['name'] != name])
+
+    def checkSyntax(self, evaluator=None):
+        """
+        Mark syntax errors in the script, setup and sections and show the
+        first tab with an error. Returns a list of (tab name, SyntaxError).
+        """
+        errors = []
+        for index in range(self.tabs.count()):
+            field = self.tabs.widget(index)
+
+            # the setup is always evaluated with exec
+            error = findSyntaxError(field.text(),
+                                    'exec' if field is self.setupTextField else evaluator)
+            field.setSyntaxError(error)
+
+            if error:
+                if not errors:
+                    self.tabs.setCurrentIndex(index)
+                errors.append((self.tabs.tabText(index), error))
+
+        return errors
+
     def evaluationStarted(self):
         self.controlBar.setStatus('Busy')
         # self.controlBar.stopButton.setEnabled(True)
@@ -267,3 +353,6 @@ class ScriptEditor(QWidget):
     def evaluationStopped(self):
         self.controlBar.setStatus('Idle')
         # self.controlBar.stopButton.setEnabled(False)
+
+    def setSourceSizes(self, sizes):
+        self.controlBar.setSourceSizes(sizes)
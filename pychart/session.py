@@ -1,14 +1,16 @@
 
-import sys
-import multiprocessing as mp
-import multiprocessing.queues as mpq
+import functools
+import itertools
+import os
 
-from IPython.core.interactiveshell import InteractiveShell
+from PyQt5.QtCore import QObject, pyqtSignal
 
-from PyQt5.QtCore import QObject, QThread, pyqtSignal
-
-from .evaluate import ProcessManager
+from .evaluate import EvaluationHub
+from .worker import getDefaultEvaluator, runJob
 
+# keys of sessions, which keep evaluation processes from reusing the cells
+# of one session's jobs for another's
+_sessionKeys = itertools.count(1)
 
 
 
@@ -17,10 +19,13 @@ class Session(QObject):
     updateStarted = pyqtSignal()
     updateFinished = pyqtSignal()
     updateErrored = pyqtSignal()
+    updateSucceeded = pyqtSignal()
 
     def __init__(self, parent=None):
         super().__init__(parent)
         self.document = None
+        self.params = None
+        self.key = next(_sessionKeys)
 
     def getDocument(self):
         return self.document
@@ -28,150 +33,280 @@ class Session(QObject):
     def setDocument(self, document):
         self.document = document
 
-    def update(self):
+    def getParams(self):
+        return self.params
+
+    def setParams(self, params):
+        """
+        Set variables defined for the script before it is evaluated.
+        """
+        self.params = params
+
+    def sectionScripts(self):
+        """
+        Scripts evaluated by an update by section name, where the document's
+        main script has the name None.
+        """
+        model = self.document.scriptEditorModel
+        scripts = {None: model.getScript()}
+        scripts.update((section['name'], section['script']) for section in model.getSections())
+        return scripts
+
+    def mergeResults(self, results):
+        """
+        Data sources of the sections' results, where later sections replace
+        sources of the same name.
+        """
+        merged = {}
+        for name in self.sectionScripts():
+            merged.update(results.get(name) or {})
+        return merged
+
+    def createJob(self, reuseCells=True, section=None):
+        """
+        Describe an evaluation of the document script, or of one of its named
+        sections, for the evaluator.
+        """
+        model = self.document.scriptEditorModel
+        return {
+            'script': self.sectionScripts()[section],
+            'setup': model.getSetup(),
+            'evaluator': model.getEvaluator() or getDefaultEvaluator(),
+            'params': self.params,
+            'bindings': self.resolveBindings(model.getBindings()),
+            'connections': model.getConnections(),
+            'reuseCells': reuseCells,
+            'session': self.key,
+        }
+
+    def resolveBindings(self, bindings):
+        """
+        Data file bindings with paths relative to the document's directory.
+        """
+        directory = os.path.dirname(self.document.filepath or '')
+        return [dict(binding, path=os.path.join(directory, os.path.expanduser(binding['path'])))
+                for binding in bindings]
+
+    def update(self, reuseCells=True):
         """
         Evaluate the script to update the chart model with latest data sources.
         Changes to the chart model will trigger an update to the chart editor.
+        Unless reuseCells is False, cells of the script which are unchanged
+        since an earlier evaluation are not run again.
         """
         self.updateStarted.emit()
-        shell = InteractiveShell()
-        script = self.document.scriptEditorModel.getScript()
-        execRes = shell.run_cell(script)
 
-        # error with syntax or execution
-        if execRes.error_before_exec or execRes.error_in_exec:
-            self.updateErrored.emit()
-            return
+        results = {}
+        for section in self.sectionScripts():
+            (result, error) = runJob(self.createJob(reuseCells, section))
+
+            # error with syntax or execution
+            if error or not isinstance(result, dict):
+                self.updateErrored.emit()
+                return
+
+            results[section] = result
 
         # update document which triggers a chart update
-        self.document.chartEditorModel.setChartDataSources(execRes.result)
+        self.document.chartEditorModel.setChartDataSources(self.mergeResults(results))
+        self.updateSucceeded.emit()
         self.updateFinished.emit()
 
 
 
 class AsyncSession(Session):
-
+    """
+    Session evaluating scripts with the evaluation hub. The document's script
+    and each of its named sections are evaluated as separate jobs, so they
+    run at the same time on different processes. Their results are merged
+    into the chart's data sources as each arrives, and updateSucceeded is
+    emitted once every section has succeeded. Sources published by a running
+    script are shown until its result, or an error, replaces them.
+    """
     updateStdout = pyqtSignal(str)
+    updateInterrupted = pyqtSignal(str)
 
     def __init__(self, parent=None):
         super().__init__(parent)
 
-        self.pm = ProcessManager()
-        self.pm.start()
-        self.pm.signals.started.connect(self.updateStarted)
-        self.pm.signals.started.connect(self._updateStateChanged)
-        self.pm.signals.finished.connect(self.updateFinished)
-        self.pm.signals.finished.connect(self._updateStateChanged)
-        self.pm.signals.error.connect(self.updateErrored)
-        self.pm.signals.result.connect(self._updateSuccess)
-        self.pm.signals.stdout.connect(self.updateStdout)
+        self.hub = EvaluationHub.instance()
+        self.id = None
 
+        # channel ids of named sections, results of the sections, and the
+        # sections the current update waits for
+        self.sectionIds = {}
+        self.results = {}
+        self.provisional = {}
+        self.waiting = set()
+        self.errored = False
 
-    def _updateStateChanged(self):
-        """
-        Signal may be out of sync with process.
-        """
-        # check process manager for evaluation state
-        if self.pm.isEvaluating():
-            self.updateStarted.emit()
-        else:
-            self.updateFinished.emit()
+        # tags of the latest job of each section, and outcomes of jobs which
+        # are ending
+        self.jobTags = itertools.count(1)
+        self.tags = {}
+        self.outcomes = {}
 
-    def _updateSuccess(self, result):
+
+    def start(self):
         """
-        Update completed successfully.
+        Register this session with the evaluation hub.
         """
-        self.document.chartEditorModel.setChartDataSources(result)
-
+        self.id = self.register(None)
 
-    def update(self):
-        # stop if already evaluating
-        if self.pm.isEvaluating():
-            self.pm.stopEvaluation()
 
-        # start script evaluation
-        script = self.document.scriptEditorModel.getScript()
-        self.pm.startEvaluation(script)
+    def register(self, section):
+        """
+        Register a channel for the jobs of a section and return its id.
+        """
+        sid = self.hub.register()
+
+        # sections added to a focused session share its priority
+        if self.id is not None and self.hub.isFocused(self.id):
+            self.hub.setFocus(*self.channelIds(), sid)
+
+        signals = self.hub.signals(sid)
+        signals.started.connect(self.updateStarted)
+        signals.started.connect(self._updateStateChanged)
+        signals.finished.connect(self.updateFinished)
+        signals.finished.connect(self._updateStateChanged)
+        signals.error.connect(functools.partial(self._jobOutcome, section, 'error', None))
+        signals.result.connect(functools.partial(self._jobOutcome, section, 'result'))
+        signals.ended.connect(functools.partial(self._jobEnded, section))
+        signals.partial.connect(functools.partial(self._updatePartial, section))
+        signals.stdout.connect(self.updateStdout)
+        signals.interrupted.connect(self.updateInterrupted)
+        return sid
+
+
+    def channelIds(self):
+        """
+        Channel ids of the script and of its sections.
+        """
+        return [self.id] + list(self.sectionIds.values())
 
 
     def stop(self):
         """
-        Stop an update.
+        Unregister this session, terminating any evaluation.
         """
-        self.pm.stopEvaluation()
-
-
+        for sid in self.channelIds():
+            self.hub.unregister(sid)
 
+        self.sectionIds = {}
 
 
+    def isEvaluating(self):
+        return any(self.hub.isEvaluating(sid) for sid in self.channelIds())
 
 
+    def focus(self):
+        """
+        Give this session's updates priority over those of other sessions.
+        """
+        self.hub.setFocus(*self.channelIds())
 
 
-
-class AsyncSession(Session):
-
-    updateStdout = pyqtSignal(str)
-
-    def __init__(self, parent=None):
-        super().__init__(parent)
-
-        self.pm = ProcessManager()
-        self.pm.signals.started.connect(self.updateStarted)
-        self.pm.signals.started.connect(self._updateStateChanged)
-        self.pm.signals.finished.connect(self.updateFinished)
-        self.pm.signals.finished.connect(self._updateStateChanged)
-        self.pm.signals.error.connect(self.updateErrored)
-        self.pm.signals.result.connect(self._updateSuccess)
-        self.pm.signals.stdout.connect(self.updateStdout)
-
-
-    def start(self):
+    def _updateStateChanged(self):
         """
-        Start the process manager within this session.
+        Signal may be out of sync with process.
         """
-        self.pm.start()
+        # check hub for evaluation state
+        if self.isEvaluating():
+            self.updateStarted.emit()
+        else:
+            self.updateFinished.emit()
 
+    def _jobOutcome(self, section, kind, result):
+        self.outcomes[section] = (kind, result)
 
-    def stop(self):
+    def _jobEnded(self, section, tag):
         """
-        Stop the process manager within this session.
+        Apply the outcome of a section's job, unless a newer job replaced it.
         """
-        self.pm.stop()
+        outcome = self.outcomes.pop(section, None)
+        if tag != self.tags.get(section):
+            return
 
+        if outcome and outcome[0] == 'result':
+            self._updateSuccess(section, outcome[1])
+        else:
+            # jobs stopped before they could send a result end without one
+            self._updateError(section, outcome is not None)
 
-    def _updateStateChanged(self):
+    def _updateSuccess(self, section, result):
         """
-        Signal may be out of sync with process.
+        Update of a section completed successfully.
         """
-        # check process manager for evaluation state
-        if self.pm.isEvaluating():
-            self.updateStarted.emit()
-        else:
-            self.updateFinished.emit()
+        self.results[section] = result
+        self.provisional.pop(section, None)
+        self.waiting.discard(section)
+        self.refreshSources()
 
-    def _updateSuccess(self, result):
+        if not self.waiting and not self.errored:
+            self.updateSucceeded.emit()
+
+    def _updatePartial(self, section, tag, sources):
         """
-        Update completed successfully.
+        Show sources published by a running section over its last result.
         """
-        self.document.chartEditorModel.setChartDataSources(result)
+        if tag == self.tags.get(section):
+            self.provisional.setdefault(section, {}).update(sources)
+            self.refreshSources()
+
+    def _updateError(self, section, errored=True):
+        self.waiting.discard(section)
+        self.errored = True
+        if self.provisional.pop(section, None) is not None:
+            self.refreshSources()
 
+        if errored:
+            self.updateErrored.emit()
+
+    def refreshSources(self):
+        results = dict(self.results)
+        for (section, sources) in self.provisional.items():
+            results[section] = {**(results.get(section) or {}), **sources}
+
+        self.document.chartEditorModel.setChartDataSources(self.mergeResults(results))
 
-    def update(self):
+
+    def update(self, reuseCells=True):
         """
-        Use the processes manager to perform an evaluation.
+        Use the evaluation hub to perform an evaluation.
         """
-        # stop if already evaluating
-        if self.pm.isEvaluating():
-            self.pm.stopEvaluation()
+        sections = self.sectionScripts()
+
+        # sections removed from the document no longer contribute sources
+        for name in set(self.sectionIds) - set(sections):
+            self.hub.unregister(self.sectionIds.pop(name))
+            self.results.pop(name, None)
+            self.provisional.pop(name, None)
+
+        self.waiting = set(sections)
+        self.errored = False
+
+        for section in sections:
+            if section is not None and section not in self.sectionIds:
+                self.sectionIds[section] = self.register(section)
+
+            sid = self.id if section is None else self.sectionIds[section]
+
+            # stop if already evaluating
+            if self.hub.isEvaluating(sid):
+                self.hub.stopEvaluation(sid)
 
-        # start script evaluation
-        script = self.document.scriptEditorModel.getScript()
-        self.pm.startEvaluation(script)
+            # start script evaluation, signals of earlier jobs are ignored
+            job = self.createJob(reuseCells, section)
+            job['tag'] = self.tags[section] = next(self.jobTags)
+            self.provisional.pop(section, None)
+            self.hub.startEvaluation(sid, job)
 
 
     def interrupt(self):
         """
-        Interrupt an update.
+        Interrupt an update. The script is sent a KeyboardInterrupt and is
+        terminated if it does not end within a grace period, updateInterrupted
+        reports which of these ended it.
         """
-        self.pm.stopEvaluation()
+        for sid in self.channelIds():
+            self.hub.stopEvaluation(sid)
@@ -0,0 +1,208 @@
+"""
+Columnar storage for chart data sources.
+
+Sequences of numbers returned by a script are stored as typed arrays, NumPy
+arrays when NumPy is installed and array module arrays otherwise, which take
+8 bytes per value instead of the ~32 bytes of a list of Python objects.
+Anything else is stored as it was returned.
+"""
+import array
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# dtype names of the column kinds stored as typed arrays
+DTYPES = {
+    bool: 'bool',
+    int: 'int64',
+    float: 'float64',
+}
+
+# column kinds of NumPy dtype kinds
+KINDS = {
+    'b': bool,
+    'i': int,
+    'u': int,
+    'f': float,
+}
+
+# array module type codes for the column kinds, bools are left as lists
+TYPECODES = {
+    'int64': 'q',
+    'float64': 'd',
+}
+
+_memoryBudget = None
+
+
+def setMemoryBudget(nbytes):
+    """
+    Limit the bytes used by the data sources of one chart, or None for no
+    limit.
+    """
+    global _memoryBudget
+    _memoryBudget = nbytes
+
+
+def getMemoryBudget():
+    return _memoryBudget
+
+
+def typeKind(valueType):
+    """
+    Column kind, bool, int or float, of values of a type, including NumPy
+    scalar types, or None.
+    """
+    if valueType in DTYPES:
+        return valueType
+
+    if numpy and issubclass(valueType, numpy.generic):
+        return KINDS.get(numpy.dtype(valueType).kind)
+
+    return None
+
+
+def columnDtype(values):
+    """
+    Name of the dtype able to hold every value of a list, or None.
+    """
+    kinds = {typeKind(t) for t in set(map(type, values))}
+
+    if not kinds or None in kinds:
+        return None
+
+    if len(kinds) == 1:
+        return DTYPES[kinds.pop()]
+
+    # ints and floats mix to float, but bools don't mix
+    if bool not in kinds:
+        return DTYPES[float]
+
+    return None
+
+
+def toColumn(values):
+    """
+    Convert a data source value to a typed array if it is a sequence of
+    numbers, otherwise return it unchanged. Objects NumPy can convert
+    without a copy, such as pandas Series, become arrays of their dtype if
+    it is numeric.
+    """
+    if numpy and isinstance(values, numpy.ndarray):
+        return values
+
+    if isinstance(values, (str, bytes, dict, array.array)):
+        return values
+
+    if numpy and hasattr(values, '__array__'):
+        column = numpy.asarray(values)
+        if column.ndim == 1 and column.dtype.kind in KINDS:
+            return column
+
+    try:
+        values = list(values)
+    except TypeError:
+        return values  # not iterable
+
+    dtype = columnDtype(values)
+    try:
+        if numpy and dtype:
+            return numpy.array(values, dtype=dtype)
+
+        if dtype in TYPECODES:
+            return array.array(TYPECODES[dtype], values)
+
+    except OverflowError:
+        pass  # ints too large for int64
+
+    return values
+
+
+def columnSize(values):
+    """
+    Approximate number of bytes used by a data source value.
+    """
+    if numpy and isinstance(values, numpy.ndarray):
+        return values.nbytes
+
+    if isinstance(values, array.array):
+        return len(values) * values.itemsize
+
+    size = sys.getsizeof(values)
+    if isinstance(values, (list, tuple)):
+        size += sum(columnSize(v) for v in values)
+
+    return size
+
+
+def columnsEqual(a, b):
+    """
+    Compare two data source values, which may be typed arrays.
+    """
+    if a is b:
+        return True
+
+    if numpy and (isinstance(a, numpy.ndarray) or isinstance(b, numpy.ndarray)):
+        try:
+            return bool(numpy.array_equal(a, b))
+        except (TypeError, ValueError):
+            return False
+
+    if isinstance(a, array.array) or isinstance(b, array.array):
+        try:
+            return len(a) == len(b) and all(x == y for x, y in zip(a, b))
+        except TypeError:
+            return False
+
+    return a == b
+
+
+
+class SourceStore(dict):
+    """
+    Mapping of data source names to columns.
+    """
+    def __init__(self, sources=None):
+        super().__init__()
+
+        for name, values in (sources or {}).items():
+            self[name] = toColumn(values)
+
+    def __eq__(self, other):
+        if not isinstance(other, dict) or self.keys() != other.keys():
+            return False
+
+        return all(columnsEqual(v, other[k]) for k, v in self.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def dtypes(self):
+        """
+        Mapping of source names to the dtype of typed columns, or None.
+        """
+        res = {}
+        for name, values in self.items():
+            if numpy and isinstance(values, numpy.ndarray):
+                res[name] = values.dtype.name
+            elif isinstance(values, array.array):
+                res[name] = {v: k for k, v in TYPECODES.items()}[values.typecode]
+            else:
+                res[name] = None
+
+        return res
+
+    def sizes(self):
+        """
+        Mapping of source names to the bytes used by each source.
+        """
+        return {name: columnSize(values) for name, values in self.items()}
+
+    def nbytes(self):
+        """
+        Total bytes used by all sources.
+        """
+        return sum(self.sizes().values())
@@ -0,0 +1,116 @@
+from PyQt5.QtCore import Qt, QSize, pyqtSignal
+from PyQt5.QtGui import QFont, QFontMetrics, QColor
+from PyQt5.Qsci import QsciScintilla, QsciLexerPython, QsciStyle
+
+
+
+class PythonTextField(QsciScintilla):
+    ERROR_MARKER_NUM = 8
+    DEFAULT_SIZE = 400
+
+    shiftReturnPressed = pyqtSignal()
+    shiftBackspacePressed = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        # Set the default font
+        font = QFont()
+        font.setFamily('Courier')
+        font.setFixedPitch(True)
+        font.setPointSize(12)
+        self.setFont(font)
+        self.setMarginsFont(font)
+
+
+
+        # Margin 0 is used for line numbers
+        fontmetrics = QFontMetrics(font)
+        self.setMarginsFont(font)
+        self.setMarginWidth(0, fontmetrics.width("0000"))
+        self.setMarginLineNumbers(0, True)
+        self.setMarginsBackgroundColor(QColor("#cccccc"))
+
+        self.setTabWidth(4)
+
+
+        # Margin 1 marks lines with syntax errors, which are annotated with
+        # the error message until the text is edited
+        self.markerDefine(QsciScintilla.RightArrow, self.ERROR_MARKER_NUM)
+        self.setMarkerBackgroundColor(QColor("#ee1111"), self.ERROR_MARKER_NUM)
+        self.setAnnotationDisplay(QsciScintilla.AnnotationBoxed)
+        self.errorStyle = QsciStyle(-1, 'Error', QColor("#cc0000"), QColor("#ffe4e4"), font)
+        self.hasSyntaxError = False
+        self.textChanged.connect(self.clearSyntaxError)
+
+        # Brace matching: enable for a brace immediately before or after
+        # the current position
+        #
+        self.setBraceMatching(QsciScintilla.SloppyBraceMatch)
+
+        # Current line visible with special background color
+        self.setCaretLineVisible(True)
+        self.setCaretLineBackgroundColor(QColor("#ffe4e4"))
+
+        # Set Python lexer
+        # Set style for Python comments (style number 1) to a fixed-width
+        # courier.
+        #
+
+        lexer = QsciLexerPython()
+        lexer.setDefaultFont(font)
+        self.setLexer(lexer)
+        text = bytearray(str.encode("Courier"))
+        self.SendScintilla(QsciScintilla.SCI_STYLESETFONT, 1, text)
+        self.SendScintilla(QsciScintilla.SCI_STYLESETSIZE, 1, 12)
+
+
+        # Don't want to see the horizontal scrollbar at all
+        # Use raw message to Scintilla here (all messages are documented
+        # here: http://www.scintilla.org/ScintillaDoc.html)
+        self.SendScintilla(QsciScintilla.SCI_SETHSCROLLBAR, 0)
+        self.setScrollWidth(1)
+
+        # not too small
+        # self.setMinimumSize(500, 450)
+
+    def setSyntaxError(self, error):
+        """
+        Mark the line of a SyntaxError and move the cursor to it, or clear
+        the mark if error is None.
+        """
+        self.clearSyntaxError()
+        if error is None or not error.lineno:
+            return
+
+        line = min(error.lineno, self.lines()) - 1
+        self.markerAdd(line, self.ERROR_MARKER_NUM)
+        self.annotate(line, f'{type(error).__name__}: {error.msg}', self.errorStyle)
+        self.setCursorPosition(line, max((error.offset or 1) - 1, 0))
+        self.ensureLineVisible(line)
+        self.hasSyntaxError = True
+
+    def clearSyntaxError(self):
+        if self.hasSyntaxError:
+            self.hasSyntaxError = False
+            self.markerDeleteAll(self.ERROR_MARKER_NUM)
+            self.clearAnnotations()
+
+    def keyPressEvent(self, e):
+        # intercept special key combos
+        if (e.key() == Qt.Key_Return and e.modifiers() == Qt.ShiftModifier):
+            self.shiftReturnPressed.emit()
+
+        elif (e.key() == Qt.Key_Backspace and e.modifiers() == Qt.ShiftModifier):
+            self.shiftBackspacePressed.emit()
+
+        elif (e.key() == Qt.Key_Tab):
+            line,idx = self.getCursorPosition()
+            self.insertAt(4 * ' ', line, idx)
+            self.setCursorPosition(line, idx + 4)
+
+        else:
+            super().keyPressEvent(e)
+
+    def sizeHint(self):
+        return QSize(self.DEFAULT_SIZE, self.DEFAULT_SIZE)
@@ -0,0 +1,270 @@
+"""
+Tiled export of chart images larger than the web view can render at once.
+
+The chart is exported once as SVG, which the web view rasterizes one tile at
+a time at the requested scale. Tiles are stitched into horizontal bands of
+the image and a background thread compresses each band into a PNG file.
+Bands hold at most BAND_SIZE bytes, fewer rows for wider images, so memory
+use is bounded whatever the size of the image.
+"""
+import os
+import queue
+import struct
+import threading
+import zlib
+
+from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtGui import QImage
+
+# largest width or height in pixels rendered as a single image
+TILE_THRESHOLD = 8192
+
+# width and height in pixels of the tiles of a tiled image
+TILE_SIZE = 2048
+
+# largest number of bytes of image rows in a band
+BAND_SIZE = 32 << 20
+
+# PNG bytes compressed before they are written as a chunk
+CHUNK_SIZE = 1 << 20
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+
+class PngWriter:
+    """
+    Write an 8-bit RGBA PNG file row by row.
+    """
+    def __init__(self, path, width, height):
+        self.width = width
+        self.height = height
+        self.rows = 0
+
+        self.file = open(path, 'wb')
+        self.compressor = zlib.compressobj()
+        self.buffer = []
+        self.size = 0
+
+        self.file.write(PNG_SIGNATURE)
+        ihdr = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+        self.writeChunk(b'IHDR', ihdr)
+
+    def writeChunk(self, kind, data):
+        crc = zlib.crc32(data, zlib.crc32(kind))
+        self.file.write(struct.pack('>I', len(data)) + kind + data +
+                        struct.pack('>I', crc))
+
+    def writeRows(self, data, count):
+        """
+        Write count rows from the RGBA bytes of consecutive rows.
+        """
+        stride = self.width * 4
+        for i in range(count):
+            # each row is prefixed with filter type 0, none
+            row = b'\0' + data[i * stride:(i + 1) * stride]
+            compressed = self.compressor.compress(row)
+            self.buffer.append(compressed)
+            self.size += len(compressed)
+
+        self.rows += count
+        if self.size >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        data = b''.join(self.buffer)
+        if data:
+            self.writeChunk(b'IDAT', data)
+        (self.buffer, self.size) = ([], 0)
+
+    def close(self):
+        assert(self.rows == self.height)
+        self.buffer.append(self.compressor.flush())
+        self.flush()
+        self.writeChunk(b'IEND', b'')
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.file.name)
+
+
+
+class BandWriter(threading.Thread):
+    """
+    Thread writing bands of image rows to a PNG file. Queuing a band blocks
+    while two bands are waiting, which bounds the memory used to four bands
+    with the band being written and the one being filled.
+    """
+    def __init__(self, path, width, height, done):
+        super().__init__(daemon=True)
+        self.writer = PngWriter(path, width, height)
+        self.bands = queue.Queue(maxsize=2)
+        self.done = done
+        self.failed = False
+
+    def put(self, data, count):
+        if not self.failed:
+            self.bands.put((data, count))
+
+    def finish(self):
+        self.bands.put(None)
+
+    def abort(self):
+        self.bands.put(False)
+
+    def run(self):
+        try:
+            while True:
+                band = self.bands.get()
+                if band is None:
+                    self.writer.close()
+                    self.done.emit(True)
+                    return
+
+                if band is False:
+                    self.writer.abort()
+                    return
+
+                self.writer.writeRows(*band)
+
+        except OSError as e:
+            print(f'Error: {e}')
+            self.writer.abort()
+
+            # unblock a band being queued
+            self.failed = True
+            while not self.bands.empty():
+                self.bands.get_nowait()
+
+            self.done.emit(False)
+
+
+
+class TiledImageExport(QObject):
+    """
+    Export of one chart image in tiles, requested from the chart one tile at
+    a time. The callback is passed True once the file has been written, or
+    False if the export failed.
+    """
+    # emitted by the writer thread
+    written = pyqtSignal(bool)
+
+    def __init__(self, handler, callback, path, width, height, scale=1,
+                 tileSize=TILE_SIZE):
+        super().__init__()
+        self.handler = handler
+        self.callback = callback
+        self.path = path
+        self.size = (width, height)
+        self.scale = scale
+
+        # size of the image in pixels
+        self.width = round(width * scale)
+        self.height = round(height * scale)
+
+        # rows of a band, and the width of tiles, which is larger when bands
+        # are short so tiles cover about as many pixels
+        self.bandRows = max(1, min(tileSize, BAND_SIZE // (self.width * 4)))
+        self.tileWidth = min(TILE_THRESHOLD, tileSize * tileSize // self.bandRows)
+
+        # tile being rendered and the band of rows it is part of
+        (self.x, self.y) = (0, 0)
+        self.band = None
+        self.writer = None
+        self.active = False
+        self.connected = False
+
+        self.written.connect(self.finish)
+
+    def start(self):
+        self.active = True
+        self.connected = True
+        self.handler.tilesPrepared.connect(self.tilesPrepared)
+        self.handler.tileReady.connect(self.tileReady)
+
+        (width, height) = self.size
+        self.handler.prepareTiles(width, height)
+
+    def tilesPrepared(self, ok):
+        if not ok:
+            return self.finish(False)
+
+        self.writer = BandWriter(self.path, self.width, self.height, self.written)
+        self.writer.start()
+        self.requestTile()
+
+    def bandHeight(self):
+        return min(self.bandRows, self.height - self.y)
+
+    def requestTile(self):
+        if self.band is None:
+            self.band = bytearray(self.width * 4 * self.bandHeight())
+
+        tile = {
+            'x': self.x,
+            'y': self.y,
+            'width': min(self.tileWidth, self.width - self.x),
+            'height': self.bandHeight(),
+            'scale': self.scale,
+        }
+        self.handler.requestTile(tile)
+
+    def tileReady(self, data):
+        image = QImage.fromData(data)
+        if image.isNull():
+            self.writer.abort()
+            return self.finish(False)
+
+        self.insertTile(image.convertToFormat(QImage.Format_RGBA8888))
+
+        self.x += self.tileWidth
+        if self.x < self.width:
+            return self.requestTile()
+
+        # band is complete, hand it to the writer and move down
+        self.writer.put(self.band, self.bandHeight())
+        (self.x, self.y, self.band) = (0, self.y + self.bandRows, None)
+
+        if self.y < self.height:
+            self.requestTile()
+        else:
+            self.disconnectHandler()
+            self.writer.finish()
+
+    def insertTile(self, image):
+        """
+        Copy the rows of a tile into the current band.
+        """
+        bits = image.constBits()
+        bits.setsize(image.byteCount())
+        data = bytes(bits)
+
+        stride = self.width * 4
+        rowSize = min(image.width(), self.width - self.x) * 4
+        for row in range(min(image.height(), self.bandHeight())):
+            start = row * image.bytesPerLine()
+            offset = row * stride + self.x * 4
+            self.band[offset:offset + rowSize] = data[start:start + rowSize]
+
+    def cancel(self):
+        """
+        Stop the export and remove the partly written file.
+        """
+        if self.active:
+            self.active = False
+            self.disconnectHandler()
+            if self.writer:
+                self.writer.abort()
+
+    def disconnectHandler(self):
+        if self.connected:
+            self.connected = False
+            self.handler.tilesPrepared.disconnect(self.tilesPrepared)
+            self.handler.tileReady.disconnect(self.tileReady)
+
+    def finish(self, ok):
+        if self.active:
+            self.active = False
+            self.disconnectHandler()
+            self.callback(ok)
@@ -0,0 +1,383 @@
+"""
+Evaluation process side of the script evaluator.
+
+This module is loaded by the fork server, so it must not import Qt or any
+other GUI module.
+"""
+import ast
+import collections
+import functools
+import hashlib
+import json
+import linecache
+import pickle
+import signal
+import sys
+import textwrap
+import threading
+import traceback
+
+from . import runtime
+from .cells import keyCells, runCells, splitCells
+
+# names of the available script evaluators
+EVALUATORS = ('ipython', 'exec')
+
+# filename shown for script lines in tracebacks
+SCRIPT_FILENAME = '<script>'
+SETUP_FILENAME = '<setup>'
+
+# number of setup namespaces kept by a process
+SETUP_CACHE_SIZE = 4
+
+# number of compiled scripts kept by a process
+COMPILE_CACHE_SIZE = 32
+
+_defaultEvaluator = 'ipython'
+_shell = None
+
+# held while a message is written to the manager, as published sources are
+# sent from a timer thread
+_sendLock = threading.Lock()
+
+# variables defined by setup scripts by hash of their code, least recently
+# used first
+_setups = collections.OrderedDict()
+
+# code objects of scripts compiled for exec by filename and hash of their
+# source, least recently used first. IPython compiles the cells it runs
+# itself, under a new filename each run, so they are not kept
+_compiled = collections.OrderedDict()
+
+# namespace of scripts with cells evaluated with exec, cleared for each
+# evaluation. Functions restored from cells of earlier evaluations look up
+# their globals in it, so they see the variables of the current evaluation
+_cellNamespace = {}
+
+
+def getDefaultEvaluator():
+    return _defaultEvaluator
+
+
+def setDefaultEvaluator(name):
+    """
+    Select the evaluator used by documents which do not specify one.
+    """
+    global _defaultEvaluator
+    assert(name in EVALUATORS)
+    _defaultEvaluator = name
+
+
+
+class StdoutPipe:
+    """
+    File object which sends anything written to it over a connection.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, msg):
+        if msg:
+            with _sendLock:
+                self.conn.send(('stdout', msg))
+        return len(msg)
+
+    def flush(self):
+        pass
+
+
+
+def sendData(conn, kind, data):
+    """
+    Send a message whose data is pickled on its own, so the manager can tell
+    which kind of message it got even if it can't unpickle the data, e.g.
+    instances of classes defined by the script.
+    """
+    data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    with _sendLock:
+        conn.send((kind, data))
+
+
+def compileScript(script, filename=SCRIPT_FILENAME):
+    """
+    Compile a script into a code object for its statements and, if the script
+    ends with an expression, a code object evaluating that expression. Code
+    of scripts compiled before is reused.
+    """
+    source = textwrap.dedent(script)
+
+    # register the source so tracebacks can show the offending lines
+    lines = source.splitlines(True)
+    linecache.cache[filename] = (len(source), None, lines, filename)
+
+    key = (filename, hashlib.sha1(source.encode()).hexdigest())
+    if key in _compiled:
+        _compiled.move_to_end(key)
+        return _compiled[key]
+
+    tree = ast.parse(source, filename)
+
+    expr = None
+    if tree.body and isinstance(tree.body[-1], ast.Expr):
+        node = ast.Expression(tree.body.pop().value)
+        expr = compile(node, filename, 'eval')
+
+    _compiled[key] = code = (compile(tree, filename, 'exec'), expr)
+    while len(_compiled) > COMPILE_CACHE_SIZE:
+        _compiled.popitem(last=False)
+
+    return code
+
+
+def findSyntaxError(script, evaluator=None):
+    """
+    Return the SyntaxError of a script, or None if it has none, without
+    running it. IPython syntax, such as magics, is allowed if the script is
+    evaluated with IPython.
+    """
+    source = textwrap.dedent(script)
+    try:
+        ast.parse(source, SCRIPT_FILENAME)
+        return None
+    except SyntaxError as e:
+        error = e
+
+    # most scripts are plain Python, so IPython is only loaded for the rest
+    if (evaluator or _defaultEvaluator) == 'ipython':
+        from IPython.core.inputtransformer2 import TransformerManager
+        try:
+            ast.parse(TransformerManager().transform_cell(source), SCRIPT_FILENAME)
+            return None
+        except SyntaxError as e:
+            error = e
+
+    return error
+
+
+def runExec(script, params=None):
+    """
+    Evaluate a script with exec and return a (result, exception) tuple. The
+    result is the value of a trailing expression, like an IPython cell. Params
+    are defined as variables of the script.
+    """
+    namespace = {'__name__': '__main__'}
+    namespace.update(params or {})
+    return execScript(script, namespace)
+
+
+def execScript(script, namespace, filename=SCRIPT_FILENAME):
+    """
+    Evaluate a script with exec in namespace, see runExec.
+    """
+    try:
+        (body, expr) = compileScript(script, filename)
+    except SyntaxError as e:
+        traceback.print_exception(type(e), e, None, file=sys.stdout)
+        return (None, e)
+
+    try:
+        exec(body, namespace)
+        result = eval(expr, namespace) if expr else None
+    except BaseException as e:
+        # skip this frame so the traceback starts in the script
+        tb = e.__traceback__.tb_next
+        traceback.print_exception(type(e), e, tb, file=sys.stdout)
+        return (None, e)
+
+    return (result, None)
+
+
+def runIPython(script, params=None):
+    """
+    Evaluate a script as an IPython cell and return a (result, exception)
+    tuple. Params are defined as variables of the script.
+    """
+    shell = resetShell()
+    shell.user_ns.update(params or {})
+    return runIPythonCell(shell, script)
+
+
+def resetShell():
+    """
+    IPython shell of earlier evaluations with a cleared namespace.
+    """
+    global _shell
+    from IPython.core.interactiveshell import InteractiveShell
+
+    if _shell is None:
+        _shell = InteractiveShell()
+    else:
+        _shell.reset(new_session=False)
+
+    return _shell
+
+
+def runIPythonCell(shell, source):
+    execRes = shell.run_cell(source)
+    return (execRes.result, execRes.error_before_exec or execRes.error_in_exec)
+
+
+def runCellScript(cells, evaluator, params=None, reuseCells=True, context=''):
+    """
+    Evaluate a script split into cells, running only the cells which changed
+    since earlier evaluations with the same context unless reuseCells is
+    False.
+    """
+    keyCells(cells, params or {}, evaluator, context)
+
+    if evaluator == 'exec':
+        namespace = _cellNamespace
+        namespace.clear()
+        namespace['__name__'] = '__main__'
+        namespace.update(params or {})
+        runCell = lambda cell: execScript(cell.padded(), namespace)
+    else:
+        shell = resetShell()
+        shell.user_ns.update(params or {})
+        namespace = shell.user_ns
+        runCell = lambda cell: runIPythonCell(shell, cell.ipythonSource())
+
+    return runCells(cells, namespace, runCell, reuseCells)
+
+
+def runScript(script, evaluator=None, params=None, reuseCells=True, context=''):
+    """
+    Evaluate a script with the named evaluator, or the default evaluator.
+    Scripts with '# %%' lines are evaluated cell by cell, see cells.
+    """
+    evaluator = evaluator or _defaultEvaluator
+
+    cells = splitCells(script)
+    if cells:
+        return runCellScript(cells, evaluator, params, reuseCells, context)
+
+    if evaluator == 'exec':
+        return runExec(script, params)
+
+    return runIPython(script, params)
+
+
+def runSetup(setup):
+    """
+    Return a (variables, exception) tuple of the variables defined by a setup
+    script. The setup is evaluated with exec the first time the process sees
+    its code, and its variables are reused after that.
+    """
+    key = hashlib.sha1(setup.encode()).hexdigest()
+    if key in _setups:
+        _setups.move_to_end(key)
+        return (_setups[key], None)
+
+    namespace = {'__name__': '__main__'}
+    (result, error) = execScript(setup, namespace, SETUP_FILENAME)
+    if error:
+        return (None, error)
+
+    variables = {k: v for k, v in namespace.items() if not k.startswith('__')}
+    _setups[key] = variables
+    while len(_setups) > SETUP_CACHE_SIZE:
+        _setups.popitem(last=False)
+
+    return (variables, None)
+
+
+def jobContext(job):
+    """
+    What cells of a job may depend on besides their variables: the session
+    evaluating it, its connection configurations and the stamps of its data
+    files.
+    """
+    from .datafiles import fileStamp
+    files = [(binding['path'], fileStamp(binding['path'])) for binding in job.get('bindings') or ()]
+    return json.dumps([job.get('session'), job.get('connections'), files], sort_keys=True, default=str)
+
+
+def runJob(job, publisher=None):
+    """
+    Evaluate the script of a job, with its params and the data files bound
+    by its document defined as variables of the script, and its document's
+    connections available from pychart.connection. Variables defined by the
+    document's setup script are defined first. Sources the script publishes
+    are passed to publisher.
+    """
+    variables = {}
+    if job.get('setup', '').strip():
+        (setup, error) = runSetup(job['setup'])
+        if error:
+            return (None, error)
+        variables.update(setup)
+
+    variables.update(job.get('params') or {})
+
+    if job.get('bindings'):
+        from .datafiles import openBindings
+        try:
+            variables.update(openBindings(job['bindings']))
+        except Exception as e:
+            traceback.print_exception(type(e), e, None, file=sys.stdout)
+            return (None, e)
+
+    # connections taken by the script go back to their pools afterwards
+    runtime.beginJob(job.get('connections'), publisher)
+    try:
+        return runScript(job['script'], job['evaluator'], variables,
+                         job.get('reuseCells', True), jobContext(job))
+    finally:
+        runtime.endJob()
+
+
+
+def initialize(evaluator):
+    """
+    Do the evaluator's one-time setup ahead of the first job.
+    """
+    if evaluator == 'ipython':
+        runIPython('')
+
+
+
+def process(conn, evaluator=None):
+    """
+    Evaluation process entry point, evaluates jobs sent over conn until None
+    is sent or the connection is closed. The given evaluator is initialized
+    before the first job is received.
+
+    SIGINT raises KeyboardInterrupt while a script runs, so the script can
+    clean up and the process stays usable. It is ignored at other times.
+    Data sources published by a script are sent while it runs, and
+    pooled connections are closed before the process exits.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    initialize(evaluator)
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            job = None
+
+        if job is None:
+            runtime.closeConnections()
+            return  # closed by the manager
+
+        orig, sys.stdout = sys.stdout, StdoutPipe(conn)
+        try:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            res = runJob(job, functools.partial(sendData, conn, 'partial'))
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        except KeyboardInterrupt as e:
+            # interrupted outside of the evaluator's own handling
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            res = (None, e)
+
+        sys.stdout = orig
+
+        # the exception was printed, only whether there was one is sent as
+        # it may not be picklable
+        (result, error) = res
+        try:
+            sendData(conn, 'result', (result, error is not None))
+        except Exception:
+            # result can't be sent, which is reported as an invalid return type
+            sendData(conn, 'result', (None, False))
@@ -11,6 +11,82 @@ function dlog(...args) {
   DEBUG && console.log(...args);
 }
 
+/**
+ * Insert sources in to trace data, where the trace meta names the sources
+ * bound to each attribute. Names of sources which are not found are cleared.
+ */
+function insertSourcesIntoTraces(traces, dataSources) {
+  function insert(a, b) {
+    for (const [k, v] of Object.entries(a)) {
+      if (typeof v === 'object') {
+        insert(v, b[k]);
+      }
+
+      // if v is a source title, skip if not set
+      else if (typeof v === 'string' && v) {
+        let src = b[k + 'src'];
+
+        // if single data source
+        if (typeof src === 'string') {
+          if (src in dataSources) {
+            b[k] = dataSources[src];
+          } else {  // source not found
+            a[k] = '';
+          }
+        }
+
+        // else if multiple data sources
+        else if (Array.isArray(src)) {
+          let found = src.filter(s => s in dataSources);
+          if (found.length) {
+            b[k] = found.map(s => dataSources[s]);
+          } else {
+            a[k] = '';
+          }
+        }
+      }
+    }
+  }
+
+  for (const trace of traces) {
+    // if trace sources are not yet defined
+    if (trace.meta && trace.meta.columnNames) {
+      insert(trace.meta.columnNames, trace);
+    }
+  }
+}
+
+
+/**
+ * Copy traces without the source data inserted by insertSourcesIntoTraces,
+ * so that changes sent to python don't include the sources. Only objects on
+ * the path to a source are copied.
+ */
+function removeSourcesFromTraces(traces) {
+  function remove(a, b) {
+    let res = Object.assign({}, b);
+    for (const [k, v] of Object.entries(a)) {
+      if (v && typeof v === 'object') {
+        if (b[k]) {
+          res[k] = remove(v, b[k]);
+        }
+      }
+
+      // skip unset source name
+      else if (typeof v === 'string' && v) {
+        delete res[k];
+      }
+    }
+    return res;
+  }
+
+  return traces.map(trace =>
+    // if trace sources are not yet defined
+    trace.meta && trace.meta.columnNames ? remove(trace.meta.columnNames, trace) : trace
+  );
+}
+
+
 // default plotly configuration
 const config = {
   editable: true,
@@ -18,12 +94,21 @@ const config = {
   modeBarButtonsToRemove: ['toImage', 'sendDataToCloud'],
 };
 
+// milliseconds layout changes are collected before being sent to python
+const LAYOUT_THROTTLE = 250;
+
 
 class App extends Component {
   constructor() {
     super();
     this.handler = null;  // web call handler
     this.renderCount = 0;
+    this.sources = {};    // source name to {revision, values}
+    this.sentLayout = {}; // layout key to JSON of the value python has
+    this.pendingLayout = null;
+    this.layoutTimer = null;
+    this.pendingRevision = null;  // revision of a state not yet rendered
+    this.tileImage = null;        // SVG image of the chart to rasterize tiles from
 
     this.state = {        // react UI state
       data: [],           // chart trace data
@@ -46,7 +131,9 @@ class App extends Component {
 
       // observe python to javascript calls
       self.handler.updateChartStateSignal.connect(self.handleChartModelChanged.bind(self));
-      self.handler.requestImageSignal.connect(self.handelImageRequest.bind(self));
+      self.handler.requestImagesSignal.connect(self.handleImagesRequest.bind(self));
+      self.handler.prepareTilesSignal.connect(self.handleTilesPrepare.bind(self));
+      self.handler.requestTileSignal.connect(self.handleTileRequest.bind(self));
 
       // signal that chart has mounted
       self.handler.chartDidMount();
@@ -56,31 +143,132 @@ class App extends Component {
 
 
   /**
-   * Generate an image from the Plotly graph and send to
-   * python via the emitImageReady handler slot.
+   * Generate images from the Plotly graph, one after another from the same
+   * rendered chart, and send them to python via the emitImagesReady handler
+   * slot. Each request has a format, width, height and scale, a size of 0
+   * uses the size of the graph.
    */
-  handelImageRequest(width, height) {
+  handleImagesRequest(jsn) {
     let graphDiv = document.getElementById('plotly-plot');
-    width = width || graphDiv.clientWidth;
-    height = height || graphDiv.clientHeight;
+    let images = [];
 
-    let options = {format: 'png', width: width, height: height};
-    plotly.toImage(graphDiv, options).then(
-        dataUrl => this.handler.emitImageReady(dataUrl)
+    let done = JSON.parse(jsn).reduce((previous, request) => previous.then(() => {
+      let options = {
+        format: request.format || 'png',
+        width: request.width || graphDiv.clientWidth,
+        height: request.height || graphDiv.clientHeight,
+        scale: request.scale || 1,
+      };
+      return plotly.toImage(graphDiv, options).then(dataUrl => images.push(dataUrl));
+    }), Promise.resolve());
+
+    done.then(() => this.handler.emitImagesReady(JSON.stringify(images)));
+  }
+
+  /**
+   * Render the chart as SVG for handleTileRequest, images larger than
+   * plotly.toImage can make are rasterized from it one tile at a time.
+   */
+  handleTilesPrepare(jsn) {
+    let graphDiv = document.getElementById('plotly-plot');
+    let request = JSON.parse(jsn);
+    let options = {
+      format: 'svg',
+      width: request.width || graphDiv.clientWidth,
+      height: request.height || graphDiv.clientHeight,
+    };
+
+    plotly.toImage(graphDiv, options).then(dataUrl => new Promise((resolve, reject) => {
+      let image = new Image();
+      image.onload = () => resolve(image);
+      image.onerror = reject;
+      image.src = dataUrl;
+    })).then(
+      image => {
+        this.tileImage = image;
+        this.handler.emitTilesPrepared(true);
+      },
+      () => this.handler.emitTilesPrepared(false)
     );
   }
 
+  /**
+   * Rasterize a tile of the prepared SVG, at x, y of the image scaled by
+   * scale, and send it to python as a PNG data url.
+   */
+  handleTileRequest(jsn) {
+    let tile = JSON.parse(jsn);
+    let image = this.tileImage;
+
+    let canvas = document.createElement('canvas');
+    canvas.width = tile.width;
+    canvas.height = tile.height;
+
+    // drawing at the scaled size rasterizes the SVG at that resolution
+    let context = canvas.getContext('2d');
+    context.translate(-tile.x, -tile.y);
+    context.drawImage(image, 0, 0, image.width * tile.scale, image.height * tile.scale);
+
+    this.handler.emitTileReady(canvas.toDataURL('image/png'));
+  }
+
+  /**
+   * Python only sends sources whose revision changed. Unchanged sources keep
+   * the same arrays, so Plotly.react skips traces whose arrays all have the
+   * same identity, and the source options are kept while the source names
+   * are unchanged so the editor panels are not re-rendered.
+   */
   handleChartModelChanged(jsn) {
     dlog('handleChartModelChanged', jsn);
 
     let state = JSON.parse(jsn);
-    // create list of data source options
-    state.dataSourceOptions = Object.keys(state.dataSources).map(
-      k => ({value: k, label: k})
-    );
+
+    // update the cache with changed sources and drop removed sources
+    let sources = {};
+    for (const [name, revision] of Object.entries(state.revisions)) {
+      let cached = this.sources[name];
+      if (name in state.dataSources || !cached || cached.revision !== revision) {
+        cached = {revision: revision, values: state.dataSources[name]};
+      }
+      sources[name] = cached;
+    }
+
+    let names = Object.keys(sources);
+    let oldNames = Object.keys(this.sources);
+    let sameNames = names.length === oldNames.length &&
+                    names.every((k, i) => k === oldNames[i]);
+    let changed = !sameNames || names.some(k => sources[k] !== this.sources[k]);
+    this.sources = sources;
+
+    if (changed || !this.state.ready) {
+      state.dataSources = {};
+      names.forEach(k => state.dataSources[k] = sources[k].values);
+    } else {
+      state.dataSources = this.state.dataSources;
+    }
+
+    if (sameNames && this.state.dataSourceOptions) {
+      state.dataSourceOptions = this.state.dataSourceOptions;
+    } else {
+      state.dataSourceOptions = names.map(k => ({value: k, label: k}));
+    }
+    delete state.revisions;
+
+    insertSourcesIntoTraces(state.data, state.dataSources);
+
+    // python now has this layout, which replaces any unsent changes
+    clearTimeout(this.layoutTimer);
+    this.layoutTimer = null;
+    this.sentLayout = {};
+    Object.entries(state.layout).forEach(([k, v]) => this.sentLayout[k] = JSON.stringify(v));
+
+    // the next render after this state is applied completes its revision
+    let revision = state.revision;
+    delete state.revision;
+
     // ready to render and emit to handler
     state.ready = true;
-    this.setState(state);
+    this.setState(state, () => this.pendingRevision = revision);
   }
 
 
@@ -90,7 +278,7 @@ class App extends Component {
   onEditorUpdate(data, layout, frames) {
     dlog('onEditorUpdate', data, layout)
 
-    this.state.ready && this.emitDataChanged(data);
+    this.state.ready && this.emitDataChanged(removeSourcesFromTraces(data));
     this.setState({data, layout, frames});
   }
 
@@ -101,12 +289,48 @@ class App extends Component {
   onChartRender(data, layout, frames) {
     dlog('onChartRender', data, layout)
 
+    // the chart shows the latest state from python
+    if (this.pendingRevision !== null) {
+      this.handler.emitRenderComplete(this.pendingRevision);
+      this.pendingRevision = null;
+    }
+
     // plotly initially calls onRender twice so ignore the first one
     if (++this.renderCount == 1) return;
 
-    // chart can change layout options such as view range
-    this.state.ready && this.emitLayoutChanged(layout);
-    this.state.ready && this.handler.emitChartUpdated()
+    // chart can change layout options such as view range, send the latest
+    // layout once per throttle interval
+    if (this.state.ready) {
+      this.pendingLayout = layout;
+      this.layoutTimer = this.layoutTimer ||
+                         setTimeout(this.flushLayout.bind(this), LAYOUT_THROTTLE);
+    }
+  }
+
+  /**
+   * Send the top-level layout keys which changed since python last had the
+   * layout, as a patch of keys to set and keys to unset.
+   */
+  flushLayout() {
+    let layout = this.pendingLayout;
+    this.layoutTimer = null;
+    this.pendingLayout = null;
+
+    let set = {};
+    for (const [k, v] of Object.entries(layout)) {
+      let jsn = JSON.stringify(v);
+      if (this.sentLayout[k] !== jsn) {
+        set[k] = v;
+        this.sentLayout[k] = jsn;
+      }
+    }
+
+    let unset = Object.keys(this.sentLayout).filter(k => !(k in layout));
+    unset.forEach(k => delete this.sentLayout[k]);
+
+    if (Object.keys(set).length || unset.length) {
+      this.emitLayoutChanged({set: set, unset: unset});
+    }
   }
 
   render() {
@@ -1,9 +1,28 @@
+import collections
+import gc
+import itertools
+import os
 import sys
+import tempfile
 import time
 import unittest
+import weakref
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from PyQt5.QtGui import QImage
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from pychart.app import Document
+from pychart.chart import ChartEditorModel, patchLayout, upgradeTracesToWebGL, revertWebGLTraces
 from pychart.session import Session, AsyncSession
+from pychart import app, datafiles, jsonio, runtime
+from pychart.sources import SourceStore
+from pychart.tiles import PngWriter
+from pychart.worker import compileScript, findSyntaxError, runExec, runJob
 
 
 class TestSession(unittest.TestCase):
@@ -36,6 +55,314 @@ class TestSession(unittest.TestCase):
         self.assertEqual(res, {'foo': [1,2,3]})
 
 
+    def test_sessionUpdateExecEvaluator(self):
+        script = """
+        def bar():
+            return [1,2,3]
+
+        {'foo': bar()}
+        """
+        model = self.document.getScriptEditorModel()
+        model.setScript(script)
+        model.setEvaluator('exec')
+        self.session.update()
+        res = self.document.getChartEditorModel().getChartDataSources()
+        self.assertEqual(res, {'foo': [1,2,3]})
+
+
+
+class TestWorker(unittest.TestCase):
+    def test_runExecResult(self):
+        self.assertEqual(runExec("x = 2\n{'foo': x}"), ({'foo': 2}, None))
+        self.assertEqual(runExec("x = 2"), (None, None))
+
+    def test_runExecParams(self):
+        self.assertEqual(runExec("{'foo': x + 1}", {'x': 1}), ({'foo': 2}, None))
+
+    def test_runExecError(self):
+        (res, exc) = runExec("1/0")
+        self.assertIsNone(res)
+        self.assertIsInstance(exc, ZeroDivisionError)
+
+        (res, exc) = runExec("{'foo': ")
+        self.assertIsInstance(exc, SyntaxError)
+
+    def test_findSyntaxError(self):
+        self.assertIsNone(findSyntaxError("{'foo': 1}", 'exec'))
+        self.assertEqual(findSyntaxError("x = 1\n{'foo': ", 'exec').lineno, 2)
+
+        # IPython syntax is only allowed for IPython
+        self.assertIsNone(findSyntaxError("%time x = 1\n{}", 'ipython'))
+        self.assertIsInstance(findSyntaxError("%time x = 1\n{}", 'exec'), SyntaxError)
+
+    def test_compileScriptCache(self):
+        self.assertIs(compileScript("x = 1\nx"), compileScript("x = 1\nx"))
+
+    def test_runJobBindings(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'prices.csv')
+            with open(path, 'w') as f:
+                f.write('day,close,symbol\n1,2.5,a\n2,3.5,b\n')
+
+            job = {
+                'script': "{'x': list(prices['day']), 'y': list(prices['close'])}",
+                'evaluator': 'exec',
+                'bindings': [{'name': 'prices', 'path': path, 'columns': ['day', 'close']}],
+            }
+            self.assertEqual(runJob(job), ({'x': [1, 2], 'y': [2.5, 3.5]}, None))
+
+            # unchanged files are opened once, columns not bound are not available
+            job['script'] = "(id(prices), 'symbol' in prices)"
+            (first, _) = runJob(job)
+            (second, _) = runJob(job)
+            self.assertEqual(first, second)
+            self.assertFalse(first[1])
+
+    def test_openBindingEvicts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for i in range(datafiles.FILE_CACHE_SIZE + 2):
+                path = os.path.join(tmp, f'{i}.csv')
+                with open(path, 'w') as f:
+                    f.write('x\n1\n')
+                datafiles.openBinding({'name': 'x', 'path': path})
+
+            # the least recently used files are closed
+            self.assertEqual(len(datafiles._files), datafiles.FILE_CACHE_SIZE)
+            self.assertNotIn((os.path.join(tmp, '0.csv'), 'csv', ()), datafiles._files)
+
+    def test_runJobSetup(self):
+        job = {
+            'script': "next(counter)",
+            'setup': "import itertools\ncounter = itertools.count()",
+            'evaluator': 'exec',
+        }
+        # setup runs once, its variables are kept between evaluations
+        self.assertEqual([runJob(job)[0] for i in range(2)], [0, 1])
+
+        job['setup'] += '\n'
+        self.assertEqual(runJob(job), (0, None))
+
+    def test_runJobCells(self):
+        script = "# %%\nfirst = next(counter)\n# %%\nn = k\n# %%\n{'n': [first, n]}"
+        params = {'counter': itertools.count(), 'k': 1}
+        job = {'script': script, 'evaluator': 'exec', 'params': params}
+        self.assertEqual(runJob(job), ({'n': [0, 1]}, None))
+
+        # only cells using a changed param or cell run again
+        params['k'] = 2
+        self.assertEqual(runJob(job), ({'n': [0, 2]}, None))
+
+        job['script'] = script.replace('n = k', 'n = k + 1')
+        self.assertEqual(runJob(job), ({'n': [0, 3]}, None))
+
+        job['reuseCells'] = False
+        self.assertEqual(runJob(job), ({'n': [1, 3]}, None))
+
+    def test_runJobCellsChanged(self):
+        script = "# %%\nx = [0]\n# %%\nx.append(1)\nx"
+        job = {'script': script, 'evaluator': 'exec'}
+        self.assertEqual([runJob(job)[0] for i in range(2)], [[0, 1]] * 2)
+
+        # a cell whose variable a later cell changed in place runs again
+        job['script'] = script.replace('append(1)', 'append(2)')
+        self.assertEqual([runJob(job)[0] for i in range(2)], [[0, 2]] * 2)
+
+    def test_runJobCellsSession(self):
+        job = {'script': "# %%\nn = next(counter)\n# %%\nn", 'evaluator': 'exec',
+               'params': {'counter': itertools.count()}}
+        self.assertEqual([runJob(job)[0] for i in range(2)], [0, 0])
+
+        # cells of other sessions are not reused
+        job['session'] = 'other'
+        self.assertEqual(runJob(job), (1, None))
+
+    def test_runJobCellsIndirect(self):
+        script = "# %%\ndef f():\n    return cfg['a']\n# %%\ncfg = {'a': 1}\n# %%\ny = f()\ny"
+        job = {'script': script, 'evaluator': 'exec'}
+        self.assertEqual(runJob(job), (1, None))
+
+        # cells depend on the variables read by the functions they call
+        job['script'] = script.replace("'a': 1", "'a': 2")
+        self.assertEqual(runJob(job), (2, None))
+
+    def test_runJobCellMagic(self):
+        job = {'script': "# %%\nx = 1\n# %%\n%%capture\nx += 1\n# %%\nx", 'evaluator': 'ipython'}
+        self.assertEqual(runJob(job), (2, None))
+
+    def test_runJobConnections(self):
+        job = {
+            'script': "import pychart\nid(pychart.connection('db'))",
+            'evaluator': 'exec',
+            'connections': {'db': {'module': 'sqlite3', 'args': [':memory:']}},
+        }
+        try:
+            # connections are kept between evaluations
+            (first, _) = runJob(job)
+            (second, _) = runJob(job)
+            self.assertEqual(first, second)
+
+            # and replaced once they stop working
+            runtime.beginJob(job['connections'])
+            conn = runtime.connection('db')
+            runtime.endJob()
+            conn.close()
+
+            (third, _) = runJob(job)
+            self.assertNotEqual(first, third)
+        finally:
+            runtime.closeConnections()
+
+    def test_runJobPublish(self):
+        script = "import pychart, time\nfor i in range(3):\n    pychart.publish({'i': i})\ntime.sleep(1)"
+        sent = []
+        runJob({'script': script, 'evaluator': 'exec'}, sent.append)
+
+        # sources published within the interval are merged and sent by a timer
+        self.assertEqual(sent, [{'i': 0}, {'i': 2}])
+
+        # and are not sent once the job has ended
+        runtime.publish({'i': 3})
+        self.assertEqual(len(sent), 2)
+
+
+
+class TestSourceStore(unittest.TestCase):
+    def test_sourceStoreColumns(self):
+        store = SourceStore({'i': range(3), 'f': [1, 2.5], 's': ['a'], 'c': 1})
+        self.assertEqual(store, {'i': [0, 1, 2], 'f': [1.0, 2.5], 's': ['a'], 'c': 1})
+        self.assertNotEqual(store, {'i': [0, 1, 3], 'f': [1.0, 2.5], 's': ['a'], 'c': 1})
+        self.assertEqual(store.dtypes()['i'], 'int64')
+        self.assertEqual(store.dtypes()['f'], 'float64')
+        self.assertIsNone(store.dtypes()['s'])
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_sourceStoreNumpyScalars(self):
+        store = SourceStore({'f': [numpy.float64(1.5), 2], 'i': [numpy.int32(1)], 'b': [numpy.bool_(True)]})
+        self.assertEqual(store.dtypes(), {'f': 'float64', 'i': 'int64', 'b': 'bool'})
+
+    def test_sourceStoreSizes(self):
+        store = SourceStore({'x': [0.5] * 1000, 'y': list(range(1000))})
+        self.assertEqual(store.sizes(), {'x': 8000, 'y': 8000})
+        self.assertEqual(store.nbytes(), 16000)
+
+    def test_sourceStoreJson(self):
+        store = SourceStore({'i': range(3), 'f': [0.5], 's': ['a']})
+        self.assertEqual(jsonio.loads(jsonio.dumps(store)), {'i': [0, 1, 2], 'f': [0.5], 's': ['a']})
+
+
+
+class TestChart(unittest.TestCase):
+    def test_webglUpgradeAndRevert(self):
+        sources = {'a': [0] * 10, 'b': [0] * 2}
+        traces = [
+            {'type': 'scatter', 'xsrc': 'a', 'meta': {}},
+            {'type': 'scatter', 'xsrc': 'a', 'meta': {'webgl': False}},
+            {'type': 'scatter', 'xsrc': 'b', 'meta': {}},
+            {'type': 'scatter', 'xsrc': 'a', 'meta': 'webglFrom label'},
+        ]
+        upgradeTracesToWebGL(traces, sources, 5)
+        self.assertEqual([t['type'] for t in traces], ['scattergl', 'scatter', 'scatter', 'scatter'])
+
+        self.assertFalse(revertWebGLTraces(traces))
+        self.assertEqual(traces[0], {'type': 'scatter', 'xsrc': 'a', 'meta': {}})
+
+    def test_patchLayout(self):
+        layout = {'title': 'a', 'xaxis': {'range': [0, 1]}, 'width': 10}
+        patch = {'set': {'xaxis': {'range': [0, 2]}}, 'unset': ['width']}
+        self.assertEqual(patchLayout(layout, patch), {'title': 'a', 'xaxis': {'range': [0, 2]}})
+        self.assertEqual(layout['width'], 10)
+
+    def test_sourceRevisions(self):
+        model = ChartEditorModel()
+        model.setChartDataSources({'a': [1, 2], 'b': [3]})
+        first = model.getChartDataSourceRevisions()
+
+        model.setChartDataSources({'a': [1, 2], 'b': [4]})
+        second = model.getChartDataSourceRevisions()
+        self.assertEqual(first['a'], second['a'])
+        self.assertNotEqual(first['b'], second['b'])
+
+
+
+class TestTiles(unittest.TestCase):
+    def test_pngWriter(self):
+        (width, height) = (3, 4)
+        red = bytes([255, 0, 0, 255]) * width
+        blue = bytes([0, 0, 255, 255]) * width
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'image.png')
+            writer = PngWriter(path, width, height)
+            writer.writeRows(red * 2, 2)
+            writer.writeRows(blue * 2, 2)
+            writer.close()
+
+            image = QImage(path)
+            self.assertEqual((image.width(), image.height()), (width, height))
+            self.assertEqual(image.pixelColor(2, 1).name(), '#ff0000')
+            self.assertEqual(image.pixelColor(0, 3).name(), '#0000ff')
+
+
+class FakeChartHandler(QObject):
+    chartReady = pyqtSignal()
+    renderComplete = pyqtSignal(int)
+
+
+
+class FakeChartEditor:
+    """
+    Chart editor which renders every image as empty bytes, without a web view.
+    """
+    def __init__(self):
+        self.handler = FakeChartHandler()
+        self.revision = 0
+        QTimer.singleShot(0, self.handler.chartReady.emit)
+
+    def setModel(self, model):
+        pass
+
+    def dataChanged(self):
+        self.revision += 1
+        revision = self.revision
+        QTimer.singleShot(0, lambda: self.handler.renderComplete.emit(revision))
+
+    def requestImages(self, callback, requests):
+        QTimer.singleShot(0, lambda: callback([b''] * len(requests)))
+
+    def cancelTiledImage(self):
+        pass
+
+
+
+def test_exportImagesReleasesSessions(qtbot, monkeypatch, tmp_path):
+    sessions = weakref.WeakSet()
+
+    class CountedSession(AsyncSession):
+        def __init__(self, parent=None):
+            super().__init__(parent)
+            sessions.add(self)
+
+    monkeypatch.setattr(app, 'ChartEditor', FakeChartEditor)
+    monkeypatch.setattr(app, 'AsyncSession', CountedSession)
+
+    document = app.Document()
+    document.getScriptEditorModel().setScript("{'x': [n] * 1000}")
+    document.toFile(str(tmp_path / 'sweep.cht'))
+
+    variants = [({'n': n}, [(str(tmp_path / f'{n}.png'), 10, 10)]) for n in range(8)]
+    failures = []
+    exporter = app.exportImages(str(tmp_path / 'sweep.cht'), variants, failures.append)
+    qtbot.waitUntil(lambda: bool(failures), timeout=20000)
+    assert(failures == [0])
+
+    # sessions of finished variants are deleted while the exporter lives on
+    def released():
+        gc.collect()
+        return not sessions
+
+    qtbot.waitUntil(released, timeout=5000)
+    assert(exporter.queue == collections.deque())
+
 
 def test_asyncSessionUpdateConstant(qtbot):
     script = "{'foo': 1}"
@@ -102,3 +429,198 @@ def test_asyncSessionUpdateInterrupt(qtbot):
 
     res = document.getChartEditorModel().getChartDataSources()
     assert(res == {})
+
+
+def test_asyncSessionUpdateRestart(qtbot):
+    script = """
+    import time
+    time.sleep(10)
+
+    {'foo': 1}
+    """
+
+    session = AsyncSession()
+    document = Document()
+    document.getScriptEditorModel().setScript(script)
+    session.setDocument(document)
+    session.start()
+
+    session.update()
+    time.sleep(1)
+
+    # a new update replaces the running evaluation
+    document.getScriptEditorModel().setScript("{'foo': 2}")
+    session.update()
+
+    model = document.getChartEditorModel()
+    qtbot.waitUntil(lambda: model.getChartDataSources() == {'foo': 2}, timeout=5000)
+
+    session.stop()
+    assert(not session.hub.isRunning())
+
+
+def test_asyncSessionFocusPriority(qtbot):
+    sessions = []
+    order = []
+    for i in range(3):
+        session = AsyncSession()
+        document = Document()
+        document.getScriptEditorModel().setScript(f"{{'foo': {i}}}")
+        document.getChartEditorModel().dataChanged.connect(
+            lambda i=i: order.append(i)
+        )
+        session.setDocument(document)
+        session.start()
+        sessions.append(session)
+
+    hub = sessions[0].hub
+    size = hub.size
+    hub.setSize(1)
+
+    # occupy the only process while the other sessions queue jobs
+    sessions[0].getDocument().getScriptEditorModel().setScript(
+        "import time\ntime.sleep(10)\n{}"
+    )
+    sessions[0].update()
+    time.sleep(1)
+    sessions[1].update()
+    sessions[2].update()
+    sessions[2].focus()
+    sessions[0].interrupt()
+
+    qtbot.waitUntil(lambda: len(order) == 2, timeout=5000)
+
+    hub.setSize(size)
+    for session in sessions:
+        session.stop()
+
+    assert(order == [2, 1])
+
+
+def test_asyncSessionInterruptCleanup(qtbot):
+    script = """
+    import time
+    try:
+        time.sleep(10)
+    finally:
+        print('cleanup')
+
+    {'foo': 1}
+    """
+
+    session = AsyncSession()
+    document = Document()
+    document.getScriptEditorModel().setScript(script)
+    session.setDocument(document)
+    session.start()
+
+    stdout = []
+    stages = []
+    session.updateStdout.connect(stdout.append)
+    session.updateInterrupted.connect(stages.append)
+
+    session.update()
+    time.sleep(1)
+    with qtbot.waitSignal(session.updateInterrupted, timeout=5000) as blocker:
+        session.interrupt()
+
+    session.stop()
+
+    # script was stopped by KeyboardInterrupt and could clean up
+    assert(stages == ['interrupt'])
+    assert('cleanup' in ''.join(stdout))
+
+
+def test_asyncSessionUnreadableResult(qtbot):
+    script = """
+    class Foo:
+        pass
+
+    {'a': Foo()}
+    """
+
+    session = AsyncSession()
+    document = Document()
+    document.getScriptEditorModel().setScript(script)
+    session.setDocument(document)
+    session.start()
+
+    # instances of script classes can't be unpickled outside the process
+    with qtbot.waitSignal(session.updateErrored, timeout=10000):
+        session.update()
+
+    session.stop()
+
+
+def test_asyncSessionCrash(qtbot):
+    session = AsyncSession()
+    document = Document()
+    document.getScriptEditorModel().setScript("import os\nos._exit(3)")
+    session.setDocument(document)
+    session.start()
+
+    # a process which exits without a result fails the update
+    with qtbot.waitSignal(session.updateErrored, timeout=5000):
+        session.update()
+
+    session.stop()
+
+
+def test_asyncSessionSections(qtbot):
+    sleep = "import time\ntime.sleep(2)\n"
+    session = AsyncSession()
+    document = Document()
+    model = document.getScriptEditorModel()
+    model.setScript("{'a': [1]}")
+    model.setSections([
+        {'name': 'b', 'script': sleep + "{'b': [2]}"},
+        {'name': 'c', 'script': sleep + "{'c': [3], 'a': [4]}"},
+    ])
+    session.setDocument(document)
+    session.start()
+
+    hub = session.hub
+    size = hub.size
+    hub.setSize(3)
+
+    start = time.monotonic()
+    with qtbot.waitSignal(session.updateSucceeded, timeout=10000):
+        session.update()
+    elapsed = time.monotonic() - start
+
+    # processes above the restored size are closed
+    hub.setSize(size)
+    qtbot.waitUntil(lambda: len(hub.workers) <= size, timeout=5000)
+    session.stop()
+
+    # sections ran at the same time and later sections replace sources
+    sources = document.getChartEditorModel().getChartDataSources()
+    assert({k: list(v) for (k, v) in sources.items()} == {'a': [4], 'b': [2], 'c': [3]})
+    assert(elapsed < 3.5)
+
+
+def test_asyncSessionPublish(qtbot):
+    script = """
+    import pychart, time
+    pychart.publish({'a': [1], 'b': [1]})
+    time.sleep(1)
+    {'a': [2]}
+    """
+
+    session = AsyncSession()
+    document = Document()
+    document.getScriptEditorModel().setScript(script)
+    session.setDocument(document)
+    session.start()
+
+    model = document.getChartEditorModel()
+    seen = []
+    model.dataChanged.connect(lambda: seen.append(
+        {k: list(v) for (k, v) in model.getChartDataSources().items()}))
+
+    with qtbot.waitSignal(session.updateSucceeded, timeout=10000):
+        session.update()
+    session.stop()
+
+    # published sources are shown until the result replaces them
+    assert(seen == [{'a': [1], 'b': [1]}, {'a': [2]}])